@@ -0,0 +1,363 @@
+#!/usr/bin/env python
+"""
+Benchmarks for ggsashimi.
+
+Synthetic spliced bam files and annotation are generated with pysam in a
+temporary folder. Each benchmark is timed (best of --repeat runs) and the
+results are printed, optionally written to a JSON file (--json) and compared
+to those of a previous run (--compare).
+
+Usage:
+    ./benchmark_sashimi.py [options] [benchmark ...]
+
+Benchmarks: read_bam read_gtf shrink aggregate make_R_lists end_to_end
+"""
+import sys, os, json, random, shutil, subprocess, tempfile, timeit
+from argparse import ArgumentParser
+from collections import OrderedDict
+import numpy as np
+import pysam
+import ggsashimi as sp
+
+
+CHR = "chrB"
+
+
+def define_options():
+        parser = ArgumentParser(description="Benchmark ggsashimi on synthetic data")
+        parser.add_argument("benchmarks", nargs="*",
+                help="Benchmarks to run [default=all]")
+        parser.add_argument("--region-size", type=int, default=100000, dest="region_size",
+                help="Size of the plotted region in bp [default=%(default)s]")
+        parser.add_argument("--exons", type=int, default=50,
+                help="Number of exons in the region [default=%(default)s]")
+        parser.add_argument("--skip", type=float, default=0.2,
+                help="Probability of a read to skip the next exon, which sets the number of distinct junctions [default=%(default)s]")
+        parser.add_argument("--depth", type=float, default=30,
+                help="Mean coverage of the exons [default=%(default)s]")
+        parser.add_argument("--read-length", type=int, default=100, dest="read_length",
+                help="Read length [default=%(default)s]")
+        parser.add_argument("--samples", type=int, default=4,
+                help="Number of bam files [default=%(default)s]")
+        parser.add_argument("--genes", type=int, default=2000,
+                help="Number of genes in the annotation, besides the one in the region [default=%(default)s]")
+        parser.add_argument("--repeat", type=int, default=3,
+                help="Number of runs of each benchmark; the best time is reported [default=%(default)s]")
+        parser.add_argument("--render", action="store_true",
+                help="Render the plots with R in the end-to-end benchmark, instead of only generating the R scripts")
+        parser.add_argument("--seed", type=int, default=1,
+                help="Random seed of the synthetic data [default=%(default)s]")
+        parser.add_argument("--json", type=str,
+                help="Write the results to this JSON file")
+        parser.add_argument("--compare", type=str,
+                help="JSON file of a previous run to compare the results with")
+        parser.add_argument("--keep", type=str,
+                help="Write the synthetic data to this folder and keep it, instead of a temporary folder")
+        return parser
+
+
+# Synthetic data
+
+def synthetic_exons(start, region_size, n_exons, rnd):
+        """Return n_exons non-overlapping (start, end) exons spread over a region,
+        as 0-based half-open intervals"""
+        spacing = region_size // n_exons
+        if spacing < 100:
+                raise ValueError("Too many exons for the region size")
+        exons = []
+        for i in range(n_exons):
+                ex_start = start + i * spacing + rnd.randint(0, spacing // 2)
+                exons.append((ex_start, ex_start + rnd.randint(spacing // 4, spacing // 2)))
+        return exons
+
+
+def synthetic_reads(exons, depth, read_length, skip, rnd):
+        """Yield the (position, cigartuples, is_reverse) of single-end reads drawn
+        from the exons. A read spanning the end of an exon continues in the next
+        one, or skips it with probability skip. Reads running past the last exon
+        are dropped."""
+        ends = np.cumsum([end - start for start, end in exons])
+        for _ in range(int(depth * ends[-1] / read_length)):
+                i = int(np.searchsorted(ends, rnd.random() * ends[-1], side="right"))
+                pos = rnd.randrange(*exons[i])
+                remaining, block_start, cigar = read_length, pos, []
+                while True:
+                        block = min(remaining, exons[i][1] - block_start)
+                        cigar.append((0, block))
+                        remaining -= block
+                        if not remaining:
+                                yield pos, cigar, rnd.random() < 0.5
+                                break
+                        i += 2 if rnd.random() < skip and i + 2 < len(exons) else 1
+                        if i >= len(exons):
+                                break
+                        cigar.append((3, exons[i][0] - (block_start + block)))
+                        block_start = exons[i][0]
+
+
+def write_bam(path, exons, chr_length, depth, read_length, skip, seed):
+        """Write a sorted and indexed bam file with synthetic spliced reads.
+        Return the number of reads."""
+        rnd = random.Random(seed)
+        reads = sorted(synthetic_reads(exons, depth, read_length, skip, rnd))
+        header = {"HD": {"VN": "1.0", "SO": "coordinate"}, "SQ": [{"SN": CHR, "LN": chr_length}]}
+        sequence = "A" * read_length
+        with pysam.AlignmentFile(path, "wb", header=header) as out:
+                for i, (pos, cigar, reverse) in enumerate(reads):
+                        read = pysam.AlignedSegment()
+                        read.query_name = "r%d" % i
+                        read.reference_id = 0
+                        read.reference_start = pos
+                        read.flag = 16 if reverse else 0
+                        read.mapping_quality = 60
+                        read.cigartuples = cigar
+                        read.query_sequence = sequence
+                        out.write(read)
+        pysam.index(path)
+        return len(reads)
+
+
+def gtf_lines(gene, exons, strand, rnd, n_transcripts=3):
+        """Yield the GTF transcript and exon lines of a gene with isoforms made
+        of random subsets of its exons (the first and last are always kept)"""
+        for t in range(n_transcripts):
+                tx_exons = [exons[0]] + [e for e in exons[1:-1] if rnd.random() > 0.2] + [exons[-1]]
+                tags = 'gene_id "%s"; transcript_id "%s.%d";' % (gene, gene, t)
+                yield "\t".join(map(str, (CHR, "synthetic", "transcript", tx_exons[0][0] + 1, tx_exons[-1][1], ".", strand, ".", tags)))
+                for start, end in tx_exons:
+                        yield "\t".join(map(str, (CHR, "synthetic", "exon", start + 1, end, ".", strand, ".", tags)))
+
+
+def write_gtf(path, exons, n_genes, seed):
+        """Write a GTF with the gene of the region followed by n_genes random
+        genes. Return the chromosome length."""
+        rnd = random.Random(seed)
+        pos = exons[-1][1] + 10000
+        with open(path, "w") as out:
+                for line in gtf_lines("region", exons, "+", rnd):
+                        out.write(line + "\n")
+                for g in range(n_genes):
+                        gene_exons = synthetic_exons(pos, rnd.randint(5000, 50000), rnd.randint(2, 15), rnd)
+                        for line in gtf_lines("gene%d" % g, gene_exons, rnd.choice("+-"), rnd):
+                                out.write(line + "\n")
+                        pos = gene_exons[-1][1] + rnd.randint(1000, 20000)
+        return pos + 10000
+
+
+class SyntheticData(object):
+        """Bam files, bam list and annotation generated in folder path"""
+
+        def __init__(self, path, args):
+                rnd = random.Random(args.seed)
+                start = 1000000
+                self.exons = synthetic_exons(start, args.region_size, args.exons, rnd)
+                self.region = "%s:%d-%d" % (CHR, start - 1000 + 1, start + args.region_size + 1000)
+                self.gtf = os.path.join(path, "annotation.gtf")
+                chr_length = write_gtf(self.gtf, self.exons, args.genes, args.seed)
+                self.indexed_gtf = sp.index_gtf(self.gtf)
+                self.bams, self.reads = [], 0
+                for i in range(args.samples):
+                        bam = os.path.join(path, "sample%d.bam" % i)
+                        self.reads += write_bam(bam, self.exons, chr_length, args.depth, args.read_length, args.skip, args.seed + i)
+                        self.bams.append(bam)
+                self.bam_list = os.path.join(path, "input_bams.tsv")
+                with open(self.bam_list, "w") as out:
+                        for i, bam in enumerate(self.bams):
+                                out.write("sample%d\t%s\tgroup%d\n" % (i, bam, i % 2))
+
+
+# Benchmarks
+
+def time_it(f, repeat=3):
+        return min(timeit.repeat(f, number=1, repeat=repeat))
+
+
+def result(name, n, t):
+        return OrderedDict([("benchmark", name), ("n", n), ("time", t)])
+
+
+def bench_read_bam(data, args):
+        """Time read_bam over all samples. n is the number of reads."""
+        results = []
+        for name, s in (("read_bam", "NONE"), ("read_bam_stranded", "SENSE")):
+                t = sum(time_it(lambda: sp.read_bam(bam, data.region, s), args.repeat) for bam in data.bams)
+                results.append(result(name, data.reads, t))
+        return results
+
+
+def bench_read_gtf(data, args):
+        """Time reading the region from the plain and from the indexed GTF. n is
+        the number of lines of the GTF."""
+        with open(data.gtf) as f:
+                n = sum(1 for _ in f)
+        return [
+                result("read_gtf", n, time_it(lambda: sp.read_gtf(data.gtf, data.region), args.repeat)),
+                result("read_gtf_indexed", n, time_it(lambda: sp.read_gtf(data.indexed_gtf, data.region), args.repeat)),
+        ]
+
+
+def random_junctions(n, start=1000000, seed=1):
+        """Return n junctions of a dense locus: donors and acceptors drawn from a
+        set of exon boundaries spread over the region"""
+        rnd = random.Random(seed)
+        boundaries = sorted(rnd.sample(range(start, start + 100 * n), max(2, n // 5) * 2))
+        dons, accs = [], []
+        for _ in range(n):
+                i = rnd.randrange(0, len(boundaries) // 2 - 1)
+                j = rnd.randrange(i + 1, min(i + 5, len(boundaries) // 2))
+                dons.append(boundaries[2*i+1])
+                accs.append(boundaries[2*j])
+        return dons, accs
+
+
+def random_annotation(n, start=1000000, seed=1):
+        """Return transcripts and exons with a total of n exons, as read_gtf"""
+        rnd = random.Random(seed)
+        transcripts, exons = OrderedDict(), OrderedDict()
+        pos = start
+        while sum(map(len, exons.values())) < n:
+                tx = '"tx%d"' % len(transcripts)
+                tx_start = pos
+                for _ in range(rnd.randint(2, 20)):
+                        ex_start = pos + rnd.randint(50, 5000)
+                        pos = ex_start + rnd.randint(50, 300)
+                        exons.setdefault(tx, []).append((ex_start, pos, '"+"'))
+                transcripts[tx] = (tx_start, pos, '"+"')
+                pos = tx_start + rnd.randint(0, 1000)
+        return transcripts, exons
+
+
+def bench_shrink(data, args, sizes=(1000, 10000, 100000)):
+        """Time shrink_junctions and make_introns for increasing number of
+        junctions and exons. Time per element should stay roughly constant."""
+        results = []
+        for n in sizes:
+                dons, accs = random_junctions(n)
+                smap = sp.shrink_map(list(sp.intersect_introns(zip(dons, accs))))
+                results.append(result("shrink_junctions", n, time_it(lambda: sp.shrink_junctions(dons, accs, smap), args.repeat)))
+                transcripts, exons = random_annotation(n)
+                results.append(result("make_introns", n, time_it(lambda: sp.make_introns(transcripts, exons, smap), args.repeat)))
+        return results
+
+
+def bench_aggregate(data, args, sizes=(10, 100, 500), length=20000):
+        """Time the mean and median of overlay groups of increasing size, on
+        tracks of length bp"""
+        rnd = np.random.RandomState(args.seed)
+        results = []
+        for n in sizes:
+                tracks = [rnd.poisson(20, length).astype(np.uint32) for _ in range(n)]
+                for aggr in ("mean", "median"):
+                        results.append(result("aggregate_" + aggr, n, time_it(lambda: sp.aggregate_density(tracks, aggr), args.repeat)))
+        return results
+
+
+def bench_make_R_lists(data, args):
+        """Time make_R_lists, with the junction arcs, on the samples of the
+        synthetic data, per base and shrunk. n is the number of positions
+        over all samples."""
+        d = OrderedDict()
+        for i, bam in enumerate(data.bams):
+                a, junctions = sp.read_bam(bam, data.region, "NONE")
+                d["sample%d" % i] = sp.prepare_for_R(a["+"], junctions["+"], data.region, 1)
+        introns = (v for vs in d.values() for v in zip(vs[2], vs[3]))
+        smap = sp.shrink_map(list(sp.intersect_introns(introns)))
+        n = sum(len(v[1]) for v in d.values())
+        fd, path = tempfile.mkstemp(suffix=".bin")
+        os.close(fd)
+
+        def run(smap):
+                data_file = sp.RData(path)
+                tracks = list(sp.plot_tracks(list(d.keys()), d, OrderedDict(), "", smap))
+                arcs, _, _ = sp.plot_junctions(tracks, "", False, list(d.values())[0][0], 1)
+                sp.make_R_lists(tracks, arcs, smap, data_file)
+                data_file.close()
+
+        try:
+                return [
+                        result("make_R_lists", n, time_it(lambda: run(None), args.repeat)),
+                        result("make_R_lists_shrink", n, time_it(lambda: run(smap), args.repeat)),
+                ]
+        finally:
+                os.remove(path)
+
+
+def bench_end_to_end(data, args):
+        """Time full runs of ggsashimi.py on the synthetic data. Unless --render is
+        given, R is not run (debug mode). n is the number of samples."""
+        script = os.path.join(os.path.dirname(os.path.abspath(__file__)), "ggsashimi.py")
+        env = dict(os.environ)
+        if not args.render:
+                env["GGSASHIMI_DEBUG"] = "1"
+        out_dir = tempfile.mkdtemp()
+        runs = [
+                ("end_to_end", []),
+                ("end_to_end_overlay", ["-O", "3", "-A", "mean"]),
+                ("end_to_end_shrink", ["--shrink", "-s", "SENSE"]),
+        ]
+        results = []
+        try:
+                with open(os.devnull, "w") as devnull:
+                        for name, options in runs:
+                                command = [sys.executable, script, "-b", data.bam_list, "-c", data.region, "-g", data.gtf,
+                                        "-o", os.path.join(out_dir, "sashimi")] + options
+                                t = time_it(lambda: subprocess.check_call(command, cwd=out_dir, env=env, stdout=devnull), args.repeat)
+                                results.append(result(name, len(data.bams), t))
+        finally:
+                shutil.rmtree(out_dir)
+        return results
+
+
+benchmarks = OrderedDict([
+        ("read_bam", bench_read_bam),
+        ("read_gtf", bench_read_gtf),
+        ("shrink", bench_shrink),
+        ("aggregate", bench_aggregate),
+        ("make_R_lists", bench_make_R_lists),
+        ("end_to_end", bench_end_to_end),
+])
+
+
+def print_results(results, baseline=None):
+        """Print the results, with the ratio to the time of the same benchmark in
+        baseline, if given"""
+        baseline = dict(((r["benchmark"], r["n"]), r["time"]) for r in baseline or [])
+        print("{:<22} {:>10} {:>12} {:>14} {:>10}".format("benchmark", "n", "time (s)", "us / element", "vs base"))
+        for r in results:
+                base = baseline.get((r["benchmark"], r["n"]))
+                ratio = "{:.2f}x".format(r["time"] / base) if base else "-"
+                print("{:<22} {:>10} {:>12.4f} {:>14.3f} {:>10}".format(r["benchmark"], r["n"], r["time"], 1e6 * r["time"] / r["n"], ratio))
+
+
+if __name__ == "__main__":
+
+        parser = define_options()
+        args = parser.parse_args()
+        names = args.benchmarks or list(benchmarks.keys())
+        for name in names:
+                if name not in benchmarks:
+                        parser.error("unknown benchmark '%s'. Available: %s" % (name, " ".join(benchmarks)))
+
+        path = args.keep or tempfile.mkdtemp()
+        if not os.path.isdir(path):
+                os.makedirs(path)
+        try:
+                data = SyntheticData(path, args)
+                results = []
+                for name in names:
+                        results += benchmarks[name](data, args)
+        finally:
+                if not args.keep:
+                        shutil.rmtree(path)
+
+        baseline = None
+        if args.compare:
+                with open(args.compare) as f:
+                        baseline = json.load(f)["results"]
+        print_results(results, baseline)
+
+        if args.json:
+                params = OrderedDict((k, v) for k, v in sorted(vars(args).items()) if k not in ("benchmarks", "json", "compare", "keep"))
+                with open(args.json, "w") as out:
+                        json.dump(OrderedDict([("version", sp.__version__), ("params", params), ("results", results)]), out, indent=2)
+                        out.write("\n")
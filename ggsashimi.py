@@ -1,10 +1,19 @@
 #!/usr/bin/env python
 
 # Import modules
+from __future__ import division
 import subprocess as sp
-import sys, re, copy, os, codecs, gzip
-from argparse import ArgumentParser, Action as ArgParseAction
-from collections import OrderedDict
+import sys, re, os, codecs, gzip, hashlib, math, random, shutil, tempfile, threading, time, json, resource, zlib
+from argparse import ArgumentParser, Namespace, Action as ArgParseAction
+from collections import OrderedDict, deque, namedtuple
+from contextlib import contextmanager
+from itertools import islice
+from concurrent.futures import Future, ProcessPoolExecutor, ThreadPoolExecutor
+try:
+        from queue import Queue, Empty
+except ImportError:
+        from Queue import Queue, Empty
+import numpy as np
 import pysam
 
 
@@ -18,7 +27,7 @@ def get_version():
         return version
 
 
-def define_options():
+def define_options(serve=False):
 
         class DebugInfoAction(ArgParseAction):
 
@@ -38,30 +47,74 @@ def define_options():
                         finally:
                                 parser.exit(returncode)
 
+        class IndexGtfAction(ArgParseAction):
+
+                def __call__(self, parser, namespace, values, option_string=None):
+                        try:
+                                print("Indexed annotation written to {}".format(index_gtf(values)))
+                        except Exception as e:
+                                print("ERROR: {}".format(e))
+                                parser.exit(1)
+                        parser.exit(0)
+
 
         # Argument parsing
-        parser = ArgumentParser(description='Create sashimi plot for a given genomic region')
+        if serve:
+                parser = ArgumentParser(prog='ggsashimi serve', description='Serve sashimi plots of a set of samples over HTTP: GET /plot?region=chr:start-end[&samples=id1,id2][&format=png][&strand=plus]')
+        else:
+                parser = ArgumentParser(description='Create sashimi plot for a given genomic region. Use "serve" as first argument to serve plots over HTTP instead (see serve -h)')
         # parser.register('action', 'debuginfo', DebugInfoAction)
         parser.add_argument("-b", "--bam", type=str, required=True,
                 help="""
-                Individual bam file or file with a list of bam files.
+                Individual bam file or file with a list of bam files
+                (cram and sam files are also accepted).
                 In the case of a list of files the format is tsv:
                 1col: id for bam file,
                 2col: path of bam file,
-                3+col: additional columns
+                3+col: additional columns.
+                Instead of a bam file, the 2col can list comma-separated
+                coverage tracks (bigWig or bedGraph, one per strand if --strand is not NONE)
+                followed by a junction file (STAR SJ.out.tab or BED as written by --junctions-bed)
                 """)
-        parser.add_argument("-c", "--coordinates", type=str, required=True,
-                help="Genomic region. Format: chr:start-end. Remember that bam coordinates are 0-based")
+        if serve:
+                parser.add_argument("--host", type=str, default="127.0.0.1",
+                        help="Address the server listens on [default=%(default)s]")
+                parser.add_argument("--port", type=int, default=8000,
+                        help="Port the server listens on, 0 for any free port [default=%(default)s]")
+                parser.add_argument("--workers", type=int, default=2,
+                        help="Number of requests processed in parallel [default=%(default)s]")
+                parser.add_argument("--queue-size", type=int, default=16, dest="queue_size",
+                        help="Maximum number of requests waiting for a worker. Requests beyond it are answered with 503 [default=%(default)s]")
+        else:
+                region = parser.add_mutually_exclusive_group(required=True)
+                region.add_argument("-c", "--coordinates", type=str,
+                        help="Genomic region. Format: chr:start-end. Remember that bam coordinates are 0-based")
+                region.add_argument("--regions", type=str,
+                        help="""
+                        BED file with several regions to plot in one run (batch mode).
+                        One plot is produced per region, named after the prefix and the
+                        4th (name) column of the BED file, or chr_start_end if missing
+                        """)
         parser.add_argument("-o", "--out-prefix", type=str, dest="out_prefix", default="sashimi",
                 help="Prefix for plot file name [default=%(default)s]")
         parser.add_argument("-S", "--out-strand", type=str, dest="out_strand", default="both",
                 help="Only for --strand other than 'NONE'. Choose which signal strand to plot: <both> <plus> <minus> [default=%(default)s]")
         parser.add_argument("-M", "--min-coverage", type=int, default=1, dest="min_coverage",
                 help="Minimum number of reads supporting a junction to be drawn [default=1]")
+        parser.add_argument("--sample-fraction", type=float, default=1, dest="sample_fraction",
+                help="Fraction of the reads of each bam file used to compute coverage and junctions, which are scaled back up. Reads are selected by a hash of their name, so the selection is the same between runs and mates are kept together [default=%(default)s]")
+        parser.add_argument("--max-reads", type=int, default=0, dest="max_reads",
+                help="Maximum number of reads used per bam file and region: files with more reads in the region are subsampled as with --sample-fraction [default=no maximum]")
+        parser.add_argument("--window-size", type=int, default=0, dest="window_size",
+                help="Read bam files in windows of this many bases, keeping the memory used per sample bounded for large regions [default=whole region]")
+        parser.add_argument("--min-reads", type=int, default=1, dest="min_reads",
+                help="Minimum number of mapped reads in the region for a sample to be plotted. Bam and cram files are screened through their index before being read; 0 disables the screen [default=%(default)s]")
         parser.add_argument("-j", "--junctions-bed", type=str, dest = "junctions_bed", default="",
                 help="Junction BED file name [default=no junction file]")
         parser.add_argument("-g", "--gtf",
-                help="Gtf file with annotation (only exons is enough)")
+                help="Gtf file with annotation (only exons is enough). A bgzip-compressed file with a tabix index (see --index-gtf) is read much faster")
+        parser.add_argument("--index-gtf", action=IndexGtfAction, metavar="GTF",
+                help="Write a sorted, compressed and tabix-indexed copy of a GTF file to be used with -g, then exit")
         parser.add_argument("-s", "--strand", default="NONE", type=str,
                 help="Strand specificity: <NONE> <SENSE> <ANTISENSE> <MATE1_SENSE> <MATE2_SENSE> [default=%(default)s]")
         parser.add_argument("--shrink", action="store_true",
@@ -93,6 +146,26 @@ def define_options():
                 help="Output file format: <pdf> <svg> <png> <jpeg> <tiff> [default=%(default)s]")
         parser.add_argument("-R", "--out-resolution", type=int, default=300, dest="out_resolution",
                 help="Output file resolution in PPI (pixels per inch). Applies only to raster output formats [default=%(default)s]")
+        parser.add_argument("--engine", type=str, default="R", choices=["R", "matplotlib"],
+                help="Plotting engine. matplotlib renders in-process, without R [default=%(default)s]")
+        parser.add_argument("-p", "--threads", type=int, default=1,
+                help="Number of processes used to read bam files in parallel [default=%(default)s]")
+        parser.add_argument("--decompression-threads", type=int, default=1, dest="decompression_threads",
+                help="Number of threads used to decompress each bam or cram file [default=%(default)s]")
+        parser.add_argument("--reference", type=str,
+                help="Reference fasta file used to decode cram files [default=reference in the cram header]")
+        parser.add_argument("--render-workers", type=int, default=1, dest="render_workers",
+                help="Number of persistent R processes used to render plots in parallel [default=%(default)s]")
+        parser.add_argument("--bin-size", type=int, dest="bin_size",
+                help="Size in bp of the bins the coverage is summarized into (maximum per bin). By default one bin per pixel of the output (--width x --out-resolution). Use 1 to plot every base")
+        parser.add_argument("--cache-dir", type=str, dest="cache_dir",
+                help="Directory where the coverage and junctions of each sample and region are cached, so that re-plotting with different display options does not read the bam files again [default=no cache]")
+        parser.add_argument("--cache-size", type=int, default=1024, dest="cache_size",
+                help="Maximum size of the cache directory in MB. Least recently used entries are removed beyond it [default=%(default)s]")
+        parser.add_argument("--metrics-json", type=str, dest="metrics_json",
+                help="Write the wall time and peak memory (on Linux) of each stage (bam reading per sample and region, shrinking, R script generation and rendering per plot) and the read counts to this JSON file")
+        parser.add_argument("--profile", action="store_true",
+                help="Profile the run with cProfile and write the stats to <out-prefix>.prof. Bam reading in worker processes (-p) is not included")
         parser.add_argument("--debug-info", action=DebugInfoAction,
                 help="Show several system information useful for debugging purposes [default=%(default)s]")
         parser.add_argument('--version', action='version', version=get_version())
@@ -101,6 +174,147 @@ def define_options():
 
 
 
+def max_rss(who=resource.RUSAGE_SELF):
+        """Return the peak resident set size in MB of the process (or of its
+        terminated children)"""
+        rss = resource.getrusage(who).ru_maxrss
+        # Reported in bytes on macOS and in kilobytes elsewhere
+        return rss / 1024.**2 if sys.platform == "darwin" else rss / 1024.
+
+
+def proc_status_mb(field):
+        """Return a memory field of /proc/self/status (e.g. VmRSS, VmHWM) in MB,
+        None where not available"""
+        try:
+                with open("/proc/self/status") as f:
+                        for line in f:
+                                if line.startswith(field + ":"):
+                                        return int(line.split()[1]) / 1024.
+        except (IOError, OSError, ValueError):
+                pass
+        return None
+
+
+class PeakMemory(object):
+        """Peak resident set size of the process during a stage. On Linux, the
+        resident size is sampled by a background thread while stages are being
+        measured, and a new high-water mark of the process (ru_maxrss) reached
+        during the stage is taken too, which catches peaks shorter than the
+        sampling interval. Overlapping stages (e.g. in server threads) each
+        include the memory used by the others."""
+
+        interval = 0.01
+        lock = threading.Lock()
+        active = set()
+        sampler = None
+        pid = None
+
+        def __init__(self):
+                self.rss = self.peak = proc_status_mb("VmRSS")
+                self.max_rss = max_rss()
+                if self.rss is None:
+                        return
+                with PeakMemory.lock:
+                        # Forked processes do not measure the stages of their parent
+                        if PeakMemory.pid != os.getpid():
+                                PeakMemory.pid, PeakMemory.active, PeakMemory.sampler = os.getpid(), set(), None
+                        PeakMemory.active.add(self)
+                        if PeakMemory.sampler is None:
+                                PeakMemory.sampler = threading.Thread(target=PeakMemory.sample)
+                                PeakMemory.sampler.daemon = True
+                                PeakMemory.sampler.start()
+
+        @staticmethod
+        def sample():
+                while True:
+                        rss = proc_status_mb("VmRSS")
+                        with PeakMemory.lock:
+                                if not PeakMemory.active:
+                                        PeakMemory.sampler = None
+                                        return
+                                for memory in PeakMemory.active:
+                                        memory.peak = max(memory.peak, rss)
+                        time.sleep(PeakMemory.interval)
+
+        @staticmethod
+        def after_fork():
+                PeakMemory.lock = threading.Lock()
+                PeakMemory.pid, PeakMemory.active, PeakMemory.sampler = os.getpid(), set(), None
+
+        def stop(self):
+                """Return the peak memory of the stage and its increase over the
+                memory at the start, in MB, none if not available"""
+                if self.rss is None:
+                        return OrderedDict()
+                rss = proc_status_mb("VmRSS")
+                with PeakMemory.lock:
+                        PeakMemory.active.discard(self)
+                        peak = max(self.peak, rss)
+                if max_rss() > self.max_rss:
+                        peak = max(peak, max_rss())
+                return OrderedDict([("peak_rss", peak), ("peak_rss_increase", max(peak - self.rss, 0))])
+
+
+# The sampling thread may hold the lock when a process pool forks
+if hasattr(os, "register_at_fork"):
+        os.register_at_fork(after_in_child=PeakMemory.after_fork)
+
+
+class Metrics(object):
+        """Wall time, peak memory and counters of each stage of a run, written
+        as JSON with --metrics-json. Stages can be recorded from several threads.
+        With max_stages, only the latest stages are kept (for long-lived servers)."""
+
+        def __init__(self, max_stages=None):
+                self.start = time.time()
+                self.stages = deque(maxlen=max_stages)
+                self.lock = threading.Lock()
+
+        def add(self, stage, info):
+                entry = OrderedDict([("stage", stage)])
+                entry.update(info)
+                with self.lock:
+                        self.stages.append(entry)
+
+        @contextmanager
+        def timer(self, stage, **info):
+                """Record the wall time and the peak memory (see PeakMemory) of
+                the block. Fields can be added to the yielded dict."""
+                info = OrderedDict(sorted(info.items()))
+                start = self.begin()
+                try:
+                        yield info
+                except BaseException:
+                        start[1].stop()
+                        raise
+                self.finish(stage, start, info)
+
+        def begin(self):
+                """Return the start of a stage, to be given to finish"""
+                return time.time(), PeakMemory()
+
+        def finish(self, stage, start, info):
+                """Record a stage started with begin"""
+                t, memory = start
+                info["time"] = time.time() - t
+                info.update(memory.stop())
+                self.add(stage, info)
+
+        def write(self, f):
+                summary = OrderedDict([
+                        ("version", __version__),
+                        ("command", sys.argv),
+                        ("time", time.time() - self.start),
+                        ("max_rss", max_rss()),
+                        ("max_rss_children", max_rss(resource.RUSAGE_CHILDREN)),
+                        ("stages", list(self.stages)),
+                ])
+                with open(f, "w") as out:
+                        json.dump(summary, out, indent=2)
+                        out.write("\n")
+
+
+
 def parse_coordinates(c):
         c = c.replace(",", "")
         chr = c.split(":")[0]
@@ -158,45 +372,506 @@ def flip_read(s, samflag):
                         return 0
 
 
-def read_bam(f, c, s):
+# CIGAR operations handled by the coverage engine: M, I, D, N, S.
+# Reads with more exotic operators (H, P, =, X, B) are ignored
+CIGAR_OPS = frozenset((0, 1, 2, 3, 4))
 
-        chr, start, end = parse_coordinates(c)
 
-        # Initialize coverage array and junction dict
-        a = {"+" : [0] * (end - start)}
-        junctions = {"+": OrderedDict()}
-        if s != "NONE":
-                a["-"] = [0] * (end - start)
-                junctions["-"] = OrderedDict()
+# Files opened by each process and thread, reused across regions. At most half
+# the soft limit of open file descriptors (and never more than MAX_OPEN_FILES)
+# are kept open per thread, so that manifests with thousands of samples stay
+# below the limit, while all the samples of a smaller manifest stay open from
+# the screen (see Sashimi.screen_samples) to the last region read
+open_files = {}
+MAX_OPEN_FILES = 1024
 
-        samfile = pysam.AlignmentFile(f)
 
-        for read in samfile.fetch(chr, start, end):
+def open_files_limit():
+        """Return the number of files open_cached keeps open per thread"""
+        soft, _ = resource.getrlimit(resource.RLIMIT_NOFILE)
+        if soft == resource.RLIM_INFINITY:
+                return MAX_OPEN_FILES
+        return max(1, min(soft // 2, MAX_OPEN_FILES))
 
-                # Move forward if read is unmapped
-                if read.is_unmapped:
-                    continue
 
-                samflag, read_start, CIGAR = read.flag, read.reference_start+1, read.cigarstring
+def open_cached(opener, f, **kwargs):
+        """Return the file f opened with opener, opening it only once per process
+        and thread. The least recently used file is closed when more than
+        open_files_limit() are open."""
+        # Key on the process and thread ids so that forked workers and server
+        # threads never share (or close) each other's file handles
+        handles = open_files.setdefault((os.getpid(), threading.current_thread().ident), OrderedDict())
+        key = (opener, f, tuple(sorted(kwargs.items())))
+        if key in handles:
+                handles[key] = handles.pop(key)
+        else:
+                handles[key] = opener(f, **kwargs)
+                limit = open_files_limit()
+                while len(handles) > limit:
+                        handles.popitem(last=False)[1].close()
+        return handles[key]
 
-                # Ignore reads with more exotic CIGAR operators
-                if any(map(lambda x: x in CIGAR, ["H", "P", "X", "="])):
-                        continue
 
-                read_strand = ["+", "-"][flip_read(s, samflag) ^ bool(int(samflag) & 16)]
-                if s == "NONE": read_strand = "+"
+def close_files():
+        """Close the files opened by the current process and thread"""
+        handles = open_files.pop((os.getpid(), threading.current_thread().ident), {})
+        for handle in handles.values():
+                handle.close()
+
+
+def open_alignment_file(f, decompression_threads=1, reference=None):
+        """Open a bam, cram or sam file. Cram files are decoded with the reference
+        fasta, if given, instead of the one referenced in their header."""
+        return open_cached(pysam.AlignmentFile, f, threads=decompression_threads, reference_filename=reference)
+
 
-                CIGAR_lens = re.split("[MIDNS]", CIGAR)[:-1]
-                CIGAR_ops = re.split("[0-9]+", CIGAR)[1:]
+def fetch_reads(f, chr, start, end, decompression_threads=1, reference=None):
+        """Yield the reads of an alignment file overlapping a region. Files without
+        index (sam) are scanned from the start with a new handle each time."""
+        samfile = open_alignment_file(f, decompression_threads, reference)
+        if samfile.has_index():
+                for read in samfile.fetch(chr, start, end):
+                        yield read
+                return
+        with pysam.AlignmentFile(f, threads=decompression_threads, reference_filename=reference) as scan:
+                for read in scan.fetch(until_eof=True):
+                        if read.reference_name == chr and read.reference_start < end and (read.reference_end or 0) > start:
+                                yield read
+
+
+def count_reads(f, c, n, decompression_threads=1, reference=None):
+        """Count the mapped reads of an indexed bam or cram file in region c, up
+        to n, so that only the first blocks of the region are decompressed.
+        Return None for files that cannot be screened this way (sam files and
+        coverage tracks)."""
+        if "," in f:
+                return None
+        samfile = open_alignment_file(f, decompression_threads, reference)
+        if not samfile.has_index():
+                return None
+        chr, start, end = parse_coordinates(c)
+        count = 0
+        for read in samfile.fetch(chr, start, end):
+                if not read.is_unmapped:
+                        count += 1
+                        if count >= n:
+                                break
+        return count
+
+
+def block_coverage(block_starts, block_ends, start, end):
+        """Return the coverage of the region [start, end) given the start and end
+        positions of the aligned blocks, using a difference array."""
+        n = end - start
+        block_starts = np.clip(np.asarray(block_starts, dtype=np.int64) - start, 0, n)
+        block_ends = np.clip(np.asarray(block_ends, dtype=np.int64) - start, 0, n)
+        diff = np.bincount(block_starts, minlength=n+1) - np.bincount(block_ends, minlength=n+1)
+        return np.cumsum(diff[:n])
+
+
+class RunLengthCoverage(object):
+        """Coverage of a region stored as runs of equal values, as returned by
+        read_bam when reading in windows. ends are the (exclusive) indexes where
+        each run stops. It stands in for the coverage array where single values
+        are looked up, and is expanded to it by np.asarray."""
+
+        def __init__(self, ends, values):
+                self.ends = np.asarray(ends, dtype=np.int64)
+                self.values = np.asarray(values)
+
+        @staticmethod
+        def from_array(y, offset=0):
+                """Return the runs of y, with ends shifted by offset"""
+                y = np.asarray(y)
+                ends = np.append(np.flatnonzero(y[1:] != y[:-1]) + 1, len(y))
+                return RunLengthCoverage(ends + offset, y[ends - 1] if len(y) else y)
+
+        @staticmethod
+        def concatenate(runs):
+                """Join the runs of consecutive stretches of a region"""
+                if not runs:
+                        return RunLengthCoverage([], np.zeros(0, dtype=np.uint32))
+                return RunLengthCoverage(np.concatenate([r.ends for r in runs]), np.concatenate([r.values for r in runs]))
+
+        def __len__(self):
+                return int(self.ends[-1]) if len(self.ends) else 0
+
+        def __getitem__(self, i):
+                if i < 0:
+                        i += len(self)
+                if not 0 <= i < len(self):
+                        raise IndexError("coverage index out of range")
+                return self.values[np.searchsorted(self.ends, i, side="right")]
+
+        def __array__(self, dtype=None, copy=None):
+                y = np.repeat(self.values, np.diff(self.ends, prepend=0))
+                return y if dtype is None else y.astype(dtype)
+
+        def any(self):
+                return bool(self.values.any())
+
+
+def count_region_reads(f, chr, start, end, decompression_threads=1, reference=None):
+        """Count all the reads of an alignment file overlapping a region"""
+        samfile = open_alignment_file(f, decompression_threads, reference)
+        if samfile.has_index():
+                return samfile.count(chr, start, end, read_callback="nofilter")
+        return sum(1 for _ in fetch_reads(f, chr, start, end, decompression_threads, reference))
+
+
+def read_bam(f, c, s, decompression_threads=1, reference=None, stats=None, sample_fraction=1., max_reads=0, window_size=0):
+        """Compute the coverage and junctions of a bam file in region c, and the
+        fraction of its reads used. With sample_fraction below 1, or more than
+        max_reads reads in the region, only a fraction of the reads, selected
+        by a hash of their name, is used, and the coverage and junction counts
+        are scaled back up. With a
+        window_size, the region is read in windows of that many bases, each one
+        reduced to coverage runs (see RunLengthCoverage) before the next."""
 
-                pos = read_start
+        chr, start, end = parse_coordinates(c)
+        n_reads, n_unmapped, n_skipped = 0, 0, 0
+
+        fraction = sample_fraction
+        if max_reads:
+                total = count_region_reads(f, chr, start, end, decompression_threads, reference)
+                if total > max_reads:
+                        fraction = min(fraction, float(max_reads) / total)
+        # Reads whose name hashes below the threshold are kept
+        threshold = int(fraction * 2**32)
+
+        # Initialize aligned block boundaries and junction dict
+        strands = ["+"] if s == "NONE" else ["+", "-"]
+        block_starts = dict((strand, []) for strand in strands)
+        block_ends = dict((strand, []) for strand in strands)
+        junctions = dict((strand, OrderedDict()) for strand in strands)
+        a = dict((strand, []) for strand in strands)
+
+        window = window_size or end - start
+        for w_start in range(start, end, window):
+                w_end = min(w_start + window, end)
+
+                for read in fetch_reads(f, chr, w_start, w_end, decompression_threads, reference):
+
+                        # Reads overlapping several windows are counted in the first one
+                        if read.reference_start < w_start and w_start > start:
+                                continue
+
+                        if fraction < 1 and zlib.crc32((read.query_name or "").encode("utf-8")) & 0xffffffff >= threshold:
+                                continue
 
-                for n, CIGAR_op in enumerate(CIGAR_ops):
-                        CIGAR_len = int(CIGAR_lens[n])
-                        pos = count_operator(CIGAR_op, CIGAR_len, pos, start, end, a[read_strand], junctions[read_strand])
+                        n_reads += 1
 
-        samfile.close()
-        return a, junctions
+                        # Move forward if read is unmapped
+                        if read.is_unmapped:
+                            n_unmapped += 1
+                            continue
+
+                        CIGAR = read.cigartuples
+
+                        # Ignore reads with more exotic CIGAR operators
+                        if not CIGAR or any(op not in CIGAR_OPS for op, _ in CIGAR):
+                                n_skipped += 1
+                                continue
+
+                        samflag = read.flag
+                        read_strand = ["+", "-"][flip_read(s, samflag) ^ bool(samflag & 16)]
+                        if s == "NONE": read_strand = "+"
+
+                        starts, ends, j = block_starts[read_strand], block_ends[read_strand], junctions[read_strand]
+
+                        # Same 1-based positions as count_operator
+                        pos = read.reference_start + 1
+
+                        for CIGAR_op, CIGAR_len in CIGAR:
+                                # Match
+                                if CIGAR_op == 0:
+                                        starts.append(pos)
+                                        ends.append(pos + CIGAR_len)
+                                # Insertion or Soft-clip
+                                elif CIGAR_op == 1 or CIGAR_op == 4:
+                                        continue
+                                # Junction
+                                elif CIGAR_op == 3:
+                                        don = pos
+                                        acc = pos + CIGAR_len
+                                        if don > start and acc < end:
+                                                j[(don,acc)] = j.get((don,acc), 0) + 1
+                                pos += CIGAR_len
+
+                # Accumulate aligned blocks into the coverage of the window, carrying
+                # the parts of blocks past its end over to the next windows
+                for strand in strands:
+                        y = block_coverage(block_starts[strand], block_ends[strand], w_start, w_end)
+                        if fraction < 1:
+                                y = np.round(y / fraction)
+                        y = y.astype(np.uint32)
+                        a[strand].append(RunLengthCoverage.from_array(y, w_start - start) if window_size else y)
+                        starts, ends = np.array(block_starts[strand], dtype=np.int64), np.array(block_ends[strand], dtype=np.int64)
+                        carried = ends > w_end
+                        block_starts[strand] = np.maximum(starts[carried], w_end).tolist()
+                        block_ends[strand] = ends[carried].tolist()
+
+        if window_size:
+                a = dict((strand, RunLengthCoverage.concatenate(a[strand])) for strand in strands)
+        else:
+                a = dict((strand, a[strand][0] if a[strand] else np.zeros(0, dtype=np.uint32)) for strand in strands)
+        if fraction < 1:
+                junctions = dict((strand, OrderedDict((k, int(round(v / fraction))) for k, v in junctions[strand].items())) for strand in strands)
+        if stats is not None:
+                stats.update(reads=n_reads, unmapped=n_unmapped, skipped=n_skipped)
+                if fraction < 1:
+                        stats.update(sample_fraction=fraction)
+        return a, junctions, fraction
+
+
+def read_coverage_track(f, c):
+        """Read the coverage of a region from a bigWig or bedGraph file. The
+        returned array has the same positions as the coverage from read_bam."""
+        chr, start, end = parse_coordinates(c)
+        n = end - start
+        # Index i of read_bam coverage is the 0-based position start+i-1
+        offset = start - 1
+        a = np.zeros(n)
+        if f.lower().endswith((".bw", ".bigwig")):
+                import pyBigWig
+                bw = open_cached(pyBigWig.open, f)
+                size = bw.chroms(chr)
+                intervals = (bw.intervals(chr, max(offset, 0), min(offset + n, size)) or []) if size else []
+        elif is_tabix_indexed(f):
+                tbx = open_cached(pysam.TabixFile, f)
+                intervals = (line.split("\t")[1:4] for line in tbx.fetch(chr, max(offset, 0), offset + n)) if chr in tbx.contigs else []
+        else:
+                with gzip.open(f, 'rt') if f.endswith(".gz") else open(f) as openf:
+                        intervals = [line.split("\t")[1:4] for line in openf if line.split("\t", 1)[0] == chr]
+        for el_start, el_end, value in intervals:
+                i, j = max(int(el_start) - offset, 0), min(int(el_end) - offset, n)
+                if i < j:
+                        a[i:j] = float(value)
+        return a
+
+
+def read_junction_file(f, c, s):
+        """Read the junctions in a region from a STAR SJ.out.tab file, or from a BED
+        file as written by --junctions-bed. Junctions with undefined strand are
+        ignored with --strand other than NONE."""
+        chr, start, end = parse_coordinates(c)
+        strands = ["+"] if s == "NONE" else ["+", "-"]
+        junctions = dict((strand, OrderedDict()) for strand in strands)
+        bed = f.lower().endswith((".bed", ".bed.gz"))
+        with gzip.open(f, 'rt') if f.endswith(".gz") else open(f) as openf:
+                for line in openf:
+                        line_sp = line.rstrip("\n").split("\t")
+                        if line_sp[0] != chr:
+                                continue
+                        if bed:
+                                # Same donor and acceptor positions as read_bam
+                                don, acc, n = int(line_sp[1]), int(line_sp[2]), int(line_sp[4])
+                                strand = line_sp[5] if len(line_sp) > 5 else None
+                        else:
+                                # First and last intronic bases (1-based), unique reads
+                                don, acc, n = int(line_sp[1]), int(line_sp[2]) + 1, int(line_sp[6])
+                                strand = {"1": "+", "2": "-"}.get(line_sp[3])
+                        if s == "NONE":
+                                strand = "+"
+                        if strand not in junctions or not n:
+                                continue
+                        if don > start and acc < end:
+                                j = junctions[strand]
+                                j[(don,acc)] = j.get((don,acc), 0) + n
+        return junctions
+
+
+def read_sample(f, c, s, decompression_threads=1, reference=None, stats=None, sample_fraction=1., max_reads=0, window_size=0):
+        """Read coverage and junctions of a sample, and the fraction of its reads
+        used (see read_bam), either from a bam file or from comma-separated
+        coverage tracks (one per strand) and a junction file.
+        Read counts of bam files are stored in the stats dict, if given. Bam
+        files are subsampled as set by sample_fraction and max_reads, and read
+        in windows of window_size bases, if given."""
+        if "," not in f:
+                return read_bam(f, c, s, decompression_threads, reference, stats, sample_fraction, max_reads, window_size)
+        files = f.split(",")
+        strands = ["+"] if s == "NONE" else ["+", "-"]
+        a = dict((strand, read_coverage_track(track, c)) for strand, track in zip(strands, files[:-1]))
+        return a, read_junction_file(files[-1], c, s), 1.
+
+
+def read_sample_stats(f, c, s, decompression_threads=1, reference=None, sample_fraction=1., max_reads=0, window_size=0):
+        """Run read_sample, returning its result along with the wall time, the
+        peak memory of the (worker) process while reading (see PeakMemory) and
+        the read counts"""
+        stats = OrderedDict()
+        t, memory = time.time(), PeakMemory()
+        result = read_sample(f, c, s, decompression_threads, reference, stats, sample_fraction, max_reads, window_size)
+        stats["time"] = time.time() - t
+        stats.update(memory.stop())
+        return result, stats
+
+
+def bam_index_mtime(f):
+        """Return the modification time of the index of a bam file, if any"""
+        mtimes = [os.path.getmtime(i) for i in (f + ".bai", f + ".csi", f + ".crai", os.path.splitext(f)[0] + ".bai") if os.path.exists(i)]
+        return max(mtimes) if mtimes else None
+
+
+class CoverageCache(object):
+        """On-disk cache of the coverage and junctions computed by read_bam, and
+        of the read counts of screen_samples.
+        Entries are keyed by bam file identity (path, size, modification time
+        of the file and its index), region, strand mode and read subsampling,
+        if any. The least recently
+        used entries are evicted as soon as the cache exceeds max_size bytes."""
+
+        def __init__(self, path, max_size):
+                self.path = path
+                self.max_size = max_size
+                # Size of the cache, as of the last eviction plus the entries
+                # written since, so that the directory is not listed on each write
+                self.size = None
+                self.lock = threading.Lock()
+                if not os.path.isdir(path):
+                        os.makedirs(path)
+
+        def entry(self, f, c, s, sampling=None):
+                files = tuple((os.path.abspath(p), os.stat(p).st_size, os.stat(p).st_mtime) for p in f.split(","))
+                key = (__version__, files, bam_index_mtime(f), parse_coordinates(c), s)
+                if sampling is not None:
+                        key += (sampling,)
+                return os.path.join(self.path, hashlib.sha1(repr(key).encode('utf-8')).hexdigest() + ".npz")
+
+        def count_entry(self, f, c):
+                # Read counts do not depend on strand mode nor subsampling
+                return self.entry(f, c, "count")
+
+        def get_count(self, f, c, n):
+                """Return the number of mapped reads in region c, up to n, as counted
+                by count_reads, or None if not in the cache"""
+                try:
+                        with np.load(self.count_entry(f, c)) as npz:
+                                count, limit = int(npz["count"]), int(npz["limit"])
+                except (IOError, OSError, ValueError, KeyError):
+                        return None
+                # Counts which reached the limit they were taken with are lower bounds
+                if count < limit or count >= n:
+                        return min(count, n)
+                return None
+
+        def put_count(self, f, c, count, limit):
+                self.write(self.count_entry(f, c), count=np.array(count), limit=np.array(limit))
+
+        def get(self, f, c, s, sampling=None):
+                entry = self.entry(f, c, s, sampling)
+                try:
+                        with np.load(entry) as npz:
+                                a, junctions = dict(), dict()
+                                for strand, name in (("+", "plus"), ("-", "minus")):
+                                        if "coverage_" + name not in npz:
+                                                continue
+                                        a[strand] = npz["coverage_" + name]
+                                        if "runs_" + name in npz:
+                                                a[strand] = RunLengthCoverage(npz["runs_" + name], a[strand])
+                                        pairs = map(tuple, npz["junctions_" + name].tolist())
+                                        junctions[strand] = OrderedDict(zip(pairs, npz["counts_" + name].tolist()))
+                                fraction = float(npz["fraction"])
+                except (IOError, OSError, ValueError, KeyError):
+                        return None
+                # Mark the entry as recently used
+                os.utime(entry, None)
+                return a, junctions, fraction
+
+        def put(self, f, c, s, result, sampling=None):
+                a, junctions, fraction = result
+                arrays = dict(fraction=np.array(fraction))
+                for strand, name in (("+", "plus"), ("-", "minus")):
+                        if strand not in a:
+                                continue
+                        arrays["coverage_" + name] = a[strand]
+                        if isinstance(a[strand], RunLengthCoverage):
+                                arrays["coverage_" + name] = a[strand].values
+                                arrays["runs_" + name] = a[strand].ends
+                        arrays["junctions_" + name] = np.array(list(junctions[strand].keys()), dtype=np.int64).reshape(-1, 2)
+                        arrays["counts_" + name] = np.array(list(junctions[strand].values()), dtype=np.int64)
+                self.write(self.entry(f, c, s, sampling), **arrays)
+
+        def write(self, entry, **arrays):
+                # Write to a temporary file first so readers never see partial entries
+                fd, tmp = tempfile.mkstemp(dir=self.path, suffix=".tmp")
+                with os.fdopen(fd, "wb") as out:
+                        np.savez_compressed(out, **arrays)
+                os.rename(tmp, entry)
+                with self.lock:
+                        if self.size is not None:
+                                self.size += os.path.getsize(entry)
+                        if self.size is None or self.size > self.max_size:
+                                self.evict()
+
+        def evict(self):
+                # Entries may be removed meanwhile by other processes sharing the cache
+                entries = []
+                for name in os.listdir(self.path):
+                        if name.endswith(".npz"):
+                                try:
+                                        st = os.stat(os.path.join(self.path, name))
+                                except OSError:
+                                        continue
+                                entries.append((st.st_mtime, st.st_size, name))
+                total = sum(size for _, size, _ in entries)
+                for _, size, name in sorted(entries):
+                        if total <= self.max_size:
+                                break
+                        try:
+                                os.remove(os.path.join(self.path, name))
+                        except OSError:
+                                pass
+                        total -= size
+                self.size = total
+
+
+def read_bams(tasks, s, threads=1, cache=None, decompression_threads=1, reference=None, metrics=None, sample_fraction=1., max_reads=0, window_size=0):
+        """Run read_sample over a list of (bam file, region) pairs, fanning out to a
+        process pool when more than one thread is requested. Results are yielded
+        in input order, keeping a bounded number of tasks in flight. Results found
+        in the cache are not recomputed, and new ones are stored in it.
+        decompression_threads, reference, sample_fraction, max_reads and
+        window_size are passed to each read_sample call, and the timing of each one is recorded
+        in metrics."""
+        metrics = metrics if metrics is not None else Metrics()
+        sampling = (sample_fraction, max_reads) if sample_fraction < 1 or max_reads else None
+
+        def lookup(f, c):
+                result = cache.get(f, c, s, sampling) if cache is not None else None
+                if result is not None:
+                        metrics.add("read_bam", OrderedDict([("file", f), ("region", c), ("cached", True)]))
+                return result
+
+        def store(f, c, result_stats):
+                result, stats = result_stats
+                metrics.add("read_bam", OrderedDict([("file", f), ("region", c), ("cached", False)] + list(stats.items())))
+                if cache is not None:
+                        cache.put(f, c, s, result, sampling)
+                return result
+
+        if threads > 1 and len(tasks) > 1:
+                with ProcessPoolExecutor(max_workers=min(threads, len(tasks))) as executor:
+                        pending = deque()
+                        for f, c in tasks:
+                                result = lookup(f, c)
+                                if result is None:
+                                        future = executor.submit(read_sample_stats, f, c, s, decompression_threads, reference, sample_fraction, max_reads, window_size)
+                                else:
+                                        future = Future()
+                                        future.set_result(result)
+                                pending.append((f, c, future, result is None))
+                                if len(pending) >= 4 * threads:
+                                        f, c, future, missed = pending.popleft()
+                                        yield store(f, c, future.result()) if missed else future.result()
+                        while pending:
+                                f, c, future, missed = pending.popleft()
+                                yield store(f, c, future.result()) if missed else future.result()
+                return
+        for f, c in tasks:
+                result = lookup(f, c)
+                yield result if result is not None else store(f, c, read_sample_stats(f, c, s, decompression_threads, reference, sample_fraction, max_reads, window_size))
 
 def get_bam_path(index, path):
         if os.path.isabs(path):
@@ -205,14 +880,14 @@ def get_bam_path(index, path):
         return os.path.join(base_dir, path)
 
 def read_bam_input(f, overlay, color, label):
-        if f.endswith(".bam"):
-                bn = f.strip().split("/")[-1].strip(".bam")
+        if f.endswith((".bam", ".cram", ".sam")):
+                bn = os.path.splitext(os.path.basename(f.strip()))[0]
                 yield bn, f, None, None, bn
                 return
         with codecs.open(f, encoding='utf-8') as openf:
                 for line in openf:
                         line_sp = line.strip().split("\t")
-                        bam = get_bam_path(f, line_sp[1])
+                        bam = ",".join(get_bam_path(f, path) for path in line_sp[1].split(","))
                         overlay_level = line_sp[overlay-1] if overlay else None
                         color_level = line_sp[color-1] if color else None
                         label_text = line_sp[label-1] if label else None
@@ -221,11 +896,10 @@ def read_bam_input(f, overlay, color, label):
 
 def prepare_for_R(a, junctions, c, m):
 
-        _, start, _ = parse_coordinates(args.coordinates)
+        _, start, _ = parse_coordinates(c)
 
-        # Convert the array index to genomic coordinates
-        x = list(i+start for i in range(len(a)))
-        y = a
+        # The coverage array is kept as is: the genomic coordinate of index i
+        # is start+i, and is only materialized when the track is plotted
 
         # Arrays for R
         dons, accs, yd, ya, counts = [], [], [], [], []
@@ -241,14 +915,16 @@ def prepare_for_R(a, junctions, c, m):
                 accs.append(acc)
                 counts.append(n)
 
-                yd.append( a[ don - start -1 ])
-                ya.append( a[ acc - start +1 ])
+                yd.append( a[ don - start -1 ].item())
+                ya.append( a[ acc - start +1 ].item())
 
-        return x, y, dons, accs, yd, ya, counts
+        return start, a, dons, accs, yd, ya, counts
 
 
 def intersect_introns(data):
         data = sorted(data)
+        if not data:
+                return
         it = iter(data)
         a, b = next(it)
         for c, d in it:
@@ -263,44 +939,177 @@ def intersect_introns(data):
 
 
 
-def shrink_density(x, y, introns):
-        new_x, new_y = [], []
-        shift = 0
-        start = 0
-        # introns are already sorted by coordinates
-        for a,b in introns:
-                end = x.index(a)+1
-                new_x += [int(i-shift) for i in x[start:end]]
-                new_y += y[start:end]
-                start = x.index(b)
-                l = (b-a)
-                shift += l-l**0.7
-        new_x += [int(i-shift) for i in x[start:]]
-        new_y += y[start:]
+def shrink_map(introns):
+        """Build the piecewise-linear map used to shrink the coordinates of a
+        strand. Each intersected intron (a, b) of length l is shrunk to int(l**0.7)
+        bp, and positions downstream are shifted by the total shrinkage upstream.
+        Return the intron starts and ends, and the cumulative shifts."""
+        introns = np.array(introns, dtype=np.int64).reshape(-1, 2)
+        l = introns[:, 1] - introns[:, 0]
+        shrinkage = l - np.array([int(i**0.7) for i in l.tolist()], dtype=np.int64)
+        return introns[:, 0], introns[:, 1], np.concatenate(([0], np.cumsum(shrinkage)))
+
+def shrink_coordinates(p, smap):
+        """Map real coordinates to the shrunk axis. Positions inside an intron are
+        scaled linearly between its shrunk boundaries. Return the shrunk
+        coordinates and a mask of the positions inside introns."""
+        starts, ends, shifts = smap
+        p = np.asarray(p, dtype=np.int64)
+        # Number of introns upstream of each position
+        k = np.searchsorted(ends, p, side="right")
+        new_p = p - shifts[k]
+        inside = np.zeros(len(p), dtype=bool)
+        downstream = k < len(starts)
+        inside[downstream] = p[downstream] > starts[k[downstream]]
+        if inside.any():
+                k, a, b = k[inside], starts[k[inside]], ends[k[inside]]
+                shrunk = (b - a) - (shifts[k+1] - shifts[k])
+                new_p[inside] = a - shifts[k] + (p[inside] - a) * shrunk // (b - a)
+        return new_p, inside
+
+def shrink_density(start, y, smap):
+        """Shrink the coordinates of a density track starting at start, dropping
+        the positions inside introns"""
+        new_x, inside = shrink_coordinates(np.arange(start, start + len(y)), smap)
+        return new_x[~inside], np.asarray(y)[~inside]
+
+def bin_density(x, y, bin_size):
+        """Summarize a density track into bins of bin_size bp anchored at the
+        first position, keeping the maximum of each bin. Bins are placed at
+        their center and bins without positions (shrunk introns) are dropped."""
+        x, y = np.asarray(x), np.asarray(y)
+        if bin_size <= 1 or not len(x):
+                return x, y
+        bins = (x - x[0]) // bin_size
+        # x is sorted, so the positions of a bin are contiguous
+        first = np.concatenate(([0], np.flatnonzero(np.diff(bins)) + 1))
+        new_x = x[0] + bins[first] * bin_size + (bin_size - 1) / 2.
+        new_y = np.maximum.reduceat(y, first)
         return new_x, new_y
 
-def shrink_junctions(dons, accs, introns):
-        new_dons, new_accs = [0]*len(dons), [0]*len(accs)
-        real_introns = dict()
-        shift_acc = 0
-        shift_don = 0
-        s = set()
-        junctions = list(zip(dons, accs))
-        for a,b in introns:
-                l = b - a
-                shift_acc += l-int(l**0.7)
-                real_introns[a - shift_don] = a
-                real_introns[b - shift_acc] = b
-                for i, (don, acc) in enumerate(junctions):
-                        if a >= don and b <= acc:
-                                if (don,acc) not in s:
-                                        new_dons[i] = don - shift_don
-                                        new_accs[i] = acc - shift_acc
-                                else:
-                                        new_accs[i] = acc - shift_acc
-                                s.add((don,acc))
-                shift_don = shift_acc
-        return real_introns, new_dons, new_accs
+def rle_density(x, y, bin_size):
+        """Collapse adjacent bins of a density track with the same value into runs.
+        Return the left and right edges of the bars covering each run, and its
+        value. Runs break where bins are not adjacent (shrunk introns, or the
+        start of another track of an overlay)."""
+        x, y = np.asarray(x), np.asarray(y)
+        if not len(x):
+                return x, x, y
+        breaks = np.flatnonzero((np.diff(y) != 0) | (np.diff(x) != bin_size)) + 1
+        first = np.concatenate(([0], breaks))
+        last = np.concatenate((breaks - 1, [len(x) - 1]))
+        return x[first] - bin_size / 2., x[last] + bin_size / 2., y[first]
+
+def density_xy(start, y, smap, bin_size):
+        """Return the plotted positions and values of a density track starting at
+        start, shrunk if smap is given and binned"""
+        if smap is not None:
+                x, y = shrink_density(start, y, smap)
+        else:
+                x = np.arange(start, start + len(y))
+        return bin_density(x, y, bin_size)
+
+def shrink_junctions(dons, accs, smap):
+        # Donors and acceptors are mapped in a single pass over the intron boundaries
+        shrunk = shrink_coordinates(list(dons) + list(accs), smap)[0].tolist()
+        return shrunk[:len(dons)], shrunk[len(dons):]
+
+def unshrink_coordinates(p, smap):
+        """Map coordinates of the shrunk axis back to real coordinates, the
+        inverse of shrink_coordinates. Return the real coordinates and a mask
+        of the positions inside introns."""
+        starts, ends, shifts = smap
+        p = np.asarray(p, dtype=np.float64)
+        # Boundaries of the introns in the shrunk axis
+        shrunk_starts, shrunk_ends = starts - shifts[:-1], ends - shifts[1:]
+        k = np.searchsorted(shrunk_ends, p, side="right")
+        real = p + shifts[k]
+        inside = np.zeros(len(p), dtype=bool)
+        downstream = k < len(starts)
+        inside[downstream] = p[downstream] > shrunk_starts[k[downstream]]
+        if inside.any():
+                k = k[inside]
+                a, b = shrunk_starts[k], shrunk_ends[k]
+                real[inside] = starts[k] + (p[inside] - a) / (b - a) * (ends[k] - starts[k])
+        return real, inside
+
+def extended_breaks(dmin, dmax, m, Q=(1, 5, 2, 2.5, 4, 3), w=(0.25, 0.2, 0.5, 0.05)):
+        """Axis breaks for the data range [dmin, dmax] with about m labels, by
+        the extended Wilkinson algorithm of Talbot et al. as implemented by
+        labeling::extended in R (used by ggplot2), so that they are the same"""
+        eps = sys.float_info.epsilon * 100
+        dmin, dmax = min(dmin, dmax), max(dmin, dmax)
+        if dmax - dmin < eps:
+                return np.linspace(dmin, dmax, m)
+        n = len(Q)
+
+        def coverage(lmin, lmax):
+                return 1 - 0.5 * ((dmax - lmax)**2 + (dmin - lmin)**2) / (0.1 * (dmax - dmin))**2
+
+        def coverage_max(span):
+                half = (span - (dmax - dmin)) / 2.
+                return 1 - 0.5 * (2 * half**2) / (0.1 * (dmax - dmin))**2 if half > 0 else 1
+
+        def density(k, lmin, lmax):
+                r = (k - 1) / (lmax - lmin)
+                rt = (m - 1) / (max(lmax, dmax) - min(dmin, lmin))
+                return 2 - max(r / rt, rt / r)
+
+        best, best_score = None, -2
+        j = 1
+        while True:
+                for i, q in enumerate(Q):
+                        sm = 1 - float(i) / (n - 1) - j + 1
+                        if w[0] * sm + w[1] + w[2] + w[3] < best_score:
+                                return seq_by(*best)
+                        k = 2
+                        while True:
+                                dm = 2 - float(k - 1) / (m - 1) if k >= m else 1
+                                if w[0] * sm + w[1] + w[2] * dm + w[3] < best_score:
+                                        break
+                                delta = (dmax - dmin) / (k + 1) / j / q
+                                z = math.ceil(math.log10(delta))
+                                while True:
+                                        step = j * q * 10.0**z
+                                        cm = coverage_max(step * (k - 1))
+                                        if w[0] * sm + w[1] * cm + w[2] * dm + w[3] < best_score:
+                                                break
+                                        min_start = math.floor(dmax / step) * j - (k - 1) * j
+                                        max_start = math.ceil(dmin / step) * j
+                                        for start in range(int(min_start), int(max_start) + 1):
+                                                lmin = start * (step / j)
+                                                lmax = lmin + step * (k - 1)
+                                                zero = (lmin % step < eps or step - lmin % step < eps) and lmin <= 0 and lmax >= 0
+                                                simplicity = 1 - float(i) / (n - 1) - j + zero
+                                                score = w[0] * simplicity + w[1] * coverage(lmin, lmax) + w[2] * density(k, lmin, lmax) + w[3]
+                                                if score > best_score:
+                                                        best, best_score = (lmin, lmax, step), score
+                                        z += 1
+                                k += 1
+                j += 1
+
+def seq_by(start, end, by):
+        """Values from start to end by steps of by, as seq(start, end, by) in R"""
+        n = int((end - start) / by + 1e-10)
+        return np.minimum(start + np.arange(n + 1) * by, end)
+
+def shrunk_axis_breaks(tracks, smap, bin_size=1):
+        """Breaks of the shrunk x axis and their labels, the real coordinates.
+        Breaks are chosen over the plotted runs of the tracks (see plot_tracks)
+        as ggplot2 would, and those up- or downstream of all the introns but
+        outside of the runs are left out."""
+        xmin = np.concatenate([t[1] for t in tracks])
+        xmax = np.concatenate([t[2] for t in tracks])
+        # Centers of the first and last bins of each run
+        runs_start, runs_end = xmin + bin_size / 2., xmax - bin_size / 2.
+        breaks = extended_breaks(runs_start.min(), runs_end.max(), 5)
+        labels, inside = unshrink_coordinates(breaks, smap)
+        labels[inside] = np.round(labels[inside])
+        starts, ends, shifts = smap
+        outer = (breaks < starts[0] - shifts[0]) | (breaks > ends[-1] - shifts[-1])
+        covered = ((breaks[:, None] >= runs_start - (bin_size - 1) / 2.) & (breaks[:, None] <= runs_end + (bin_size - 1) / 2.)).any(axis=1)
+        kept = ~outer | covered
+        return breaks[kept], labels[kept]
 
 def read_palette(f):
         palette = "#ff0000", "#00ff00", "#0000ff", "#000000"
@@ -310,64 +1119,94 @@ def read_palette(f):
         return palette
 
 
-def read_gtf(f, c):
+def parse_gtf(lines, chrs=None):
+        """Parse transcript and exon records from GTF lines, optionally restricted
+        to a set of chromosomes. Records are returned in a dict keyed by chromosome."""
+        records = dict()
+        for line in lines:
+                if line.startswith("#"):
+                        continue
+                el_chr, _, el, el_start, el_end, _, strand, _, tags = line.strip().split("\t")
+                if chrs is not None and el_chr not in chrs:
+                        continue
+                if el not in ("transcript", "exon"):
+                        continue
+                try:
+                        transcript_id = re.findall('transcript_id ("[^"]+")', tags)[0]
+                except IndexError:
+                        print("ERROR: 'transcript_id' attribute is missing in the GTF file.")
+                        exit(1)
+                records.setdefault(el_chr, []).append((el, int(el_start) -1, int(el_end), '"' + strand + '"', transcript_id))
+        return records
+
+
+def load_gtf(f, chrs=None):
+        with gzip.open(f, 'rt') if f.endswith(".gz") else open(f) as openf:
+                return parse_gtf(openf, chrs)
+
+
+def is_tabix_indexed(f):
+        """Check whether f is a bgzip-compressed file with a tabix index"""
+        return f.endswith(".gz") and (os.path.exists(f + ".tbi") or os.path.exists(f + ".csi"))
+
+
+def index_gtf(f):
+        """Write a sorted, bgzip-compressed and tabix-indexed copy of a GTF file.
+        Return the name of the indexed file."""
+        out = re.sub(r"(\.gtf)?(\.gz)?$", "", f) + ".sorted.gtf"
+        # Sort by chromosome and start with sort(1), which spills to temporary
+        # files rather than holding whole genome annotations in memory
+        env = dict(os.environ, LC_ALL="C")
+        with open(out, 'wb') as outf:
+                p = sp.Popen(["sort", "-s", "-t", "\t", "-k1,1", "-k4,4n"], stdin=sp.PIPE, stdout=outf, env=env)
+                with gzip.open(f, 'rb') if f.endswith(".gz") else open(f, 'rb') as openf:
+                        for line in openf:
+                                if not line.startswith(b"#"):
+                                        p.stdin.write(line)
+                p.stdin.close()
+                if p.wait() != 0:
+                        raise OSError("Could not sort {}".format(f))
+        # Compress and index, removing the uncompressed copy
+        return pysam.tabix_index(out, preset="gff", force=True)
+
+
+def select_gtf(records, c):
         exons = OrderedDict()
         transcripts = OrderedDict()
         chr, start, end = parse_coordinates(c)
         end = end -1
-        with gzip.open(f, 'rt') if f.endswith(".gz") else open(f) as openf:
-                for line in openf:
-                        if line.startswith("#"):
-                                continue
-                        el_chr, _, el, el_start, el_end, _, strand, _, tags = line.strip().split("\t")
-                        if el_chr != chr:
-                                continue
-                        if el not in ("transcript", "exon"):
-                                continue
-                        try:
-                                transcript_id = re.findall('transcript_id ("[^"]+")', tags)[0]
-                        except KeyError:
-                                print("ERROR: 'transcript_id' attribute is missing in the GTF file.")
-                                exit(1)
-                        el_start, el_end = int(el_start) -1, int(el_end)
-                        strand = '"' + strand + '"'
-                        if el == "transcript":
-                                if (el_end > start and el_start < end):
-                                        transcripts[transcript_id] = max(start, el_start), min(end, el_end), strand
-                                continue
-                        if el == "exon":
-                                if (start < el_start < end or start < el_end < end):
-                                        exons.setdefault(transcript_id, []).append((max(el_start, start), min(end, el_end), strand))
+        for el, el_start, el_end, strand, transcript_id in records.get(chr, []):
+                if el == "transcript":
+                        if (el_end > start and el_start < end):
+                                transcripts[transcript_id] = max(start, el_start), min(end, el_end), strand
+                        continue
+                if el == "exon":
+                        if (start < el_start < end or start < el_end < end):
+                                exons.setdefault(transcript_id, []).append((max(el_start, start), min(end, el_end), strand))
 
         return transcripts, exons
 
 
-def make_introns(transcripts, exons, intersected_introns=None):
-        new_transcripts = copy.deepcopy(transcripts)
-        new_exons = copy.deepcopy(exons)
-        introns = OrderedDict()
-        if intersected_introns:
-                for tx, (tx_start,tx_end,strand) in new_transcripts.items():
-                        total_shift = 0
-                        for a,b in intersected_introns:
-                                l = b - a
-                                shift = l - int(l**0.7)
-                                total_shift += shift
-                                for i, (exon_start,exon_end,strand) in enumerate(exons.get(tx,[])):
-                                        new_exon_start, new_exon_end = new_exons[tx][i][:2]
-                                        if a < exon_start:
-                                                if b > exon_end:
-                                                        if i ==  len(exons[tx])-1:
-                                                                total_shift = total_shift - shift + (exon_start - a)*(1-int(l**-0.3))
-                                                        shift = (exon_start - a)*(1-int(l**-0.3))
-                                                        new_exon_end = new_exons[tx][i][1] - shift
-                                                new_exon_start = new_exons[tx][i][0] - shift
-                                        if b <= exon_end:
-                                                new_exon_end = new_exons[tx][i][1] - shift
-                                        new_exons[tx][i] = (new_exon_start,new_exon_end,strand)
-                        tx_start = min(tx_start, sorted(new_exons.get(tx, [[sys.maxsize]]))[0][0])
-                        new_transcripts[tx] = (tx_start, tx_end - total_shift, strand)
+def read_gtf(f, c):
+        chr, start, end = parse_coordinates(c)
+        if is_tabix_indexed(f):
+                tbx = open_cached(pysam.TabixFile, f)
+                lines = tbx.fetch(chr, start, end) if chr in tbx.contigs else []
+                return select_gtf(parse_gtf(lines), c)
+        return select_gtf(load_gtf(f, [chr]), c)
+
 
+def make_introns(transcripts, exons, smap=None):
+        new_transcripts, new_exons = transcripts, exons
+        introns = OrderedDict()
+        if smap is not None:
+                # Shrink all transcript and exon coordinates in one sweep over the intron boundaries
+                coords = [c for v in transcripts.values() for c in v[:2]] + [c for vs in exons.values() for v in vs for c in v[:2]]
+                shrunk = iter(shrink_coordinates(coords, smap)[0].tolist())
+                new_transcripts = OrderedDict((tx, (next(shrunk), next(shrunk), strand)) for tx, (_, _, strand) in transcripts.items())
+                new_exons = OrderedDict((tx, [(next(shrunk), next(shrunk), strand) for _, _, strand in vs]) for tx, vs in exons.items())
+
+        # Introns are the gaps between consecutive exons of each transcript
         for tx, (tx_start,tx_end,strand) in new_transcripts.items():
                 intron_start = tx_start
                 ex_end = 0
@@ -382,7 +1221,7 @@ def make_introns(transcripts, exons, intersected_introns=None):
         return d
 
 
-def gtf_for_ggplot(annotation, start, end, arrow_bins):
+def gtf_for_ggplot(annotation, start, end, arrow_bins, data):
         arrow_space = int((end - start)/arrow_bins)
         s = """
 
@@ -398,15 +1237,15 @@ def gtf_for_ggplot(annotation, start, end, arrow_bins):
                 s += """
                 ann_list[['exons']] = data.table(
                         tx = rep(c(%(tx_exons)s), c(%(n_exons)s)),
-                        start = c(%(exon_start)s),
-                        end = c(%(exon_end)s),
+                        start = %(exon_start)s,
+                        end = %(exon_end)s,
                         strand = c(%(strand)s)
                 )
                 """ %({
                 "tx_exons": ",".join(annotation["exons"].keys()),
                 "n_exons": ",".join(map(str, map(len, annotation["exons"].values()))),
-                "exon_start" : ",".join(map(str, (v[0] for vs in annotation["exons"].values() for v in vs))),
-                "exon_end" : ",".join(map(str, (v[1] for vs in annotation["exons"].values() for v in vs))),
+                "exon_start" : data.column([v[0] for vs in annotation["exons"].values() for v in vs]),
+                "exon_end" : data.column([v[1] for vs in annotation["exons"].values() for v in vs]),
                 "strand" : ",".join(map(str, (v[2] for vs in annotation["exons"].values() for v in vs))),
                 })
 
@@ -415,8 +1254,8 @@ def gtf_for_ggplot(annotation, start, end, arrow_bins):
                 s += """
                 ann_list[['introns']] = data.table(
                         tx = rep(c(%(tx_introns)s), c(%(n_introns)s)),
-                        start = c(%(intron_start)s),
-                        end = c(%(intron_end)s),
+                        start = %(intron_start)s,
+                        end = %(intron_end)s,
                         strand = c(%(strand)s)
                 )
                 # Create data table for strand arrows
@@ -447,8 +1286,8 @@ def gtf_for_ggplot(annotation, start, end, arrow_bins):
                 """ %({
                         "tx_introns": ",".join(annotation["introns"].keys()),
                         "n_introns": ",".join(map(str, map(len, annotation["introns"].values()))),
-                        "intron_start" : ",".join(map(str, (v[0] for vs in annotation["introns"].values() for v in vs))),
-                        "intron_end" : ",".join(map(str, (v[1] for vs in annotation["introns"].values() for v in vs))),
+                        "intron_start" : data.column([v[0] for vs in annotation["introns"].values() for v in vs]),
+                        "intron_end" : data.column([v[1] for vs in annotation["introns"].values() for v in vs]),
                         "strand" : ",".join(map(str, (v[2] for vs in annotation["introns"].values() for v in vs))),
                         "arrow_space" : arrow_space,
                 })
@@ -473,7 +1312,7 @@ def gtf_for_ggplot(annotation, start, end, arrow_bins):
         return s
 
 
-def setup_R_script(h, w, b, label_dict):
+def setup_R_script(h, w, b, label_dict, data):
         s = """
         library(ggplot2)
         library(grid)
@@ -481,10 +1320,13 @@ def setup_R_script(h, w, b, label_dict):
         library(data.table)
         library(gtable)
 
-        scale_lwd = function(r) {
-                lmin = 0.1
-                lmax = 4
-                return( r*(lmax-lmin)+lmin )
+        # Numeric columns are stored in a binary file (see RData)
+        data_file = "%(data)s"
+        read_column = function(type, offset, n) {
+                con = file(data_file, "rb")
+                on.exit(close(con))
+                seek(con, offset)
+                as.numeric(readBin(con, type, n, size=ifelse(type == "integer", 4, 8), endian="little"))
         }
 
         base_size = %(b)s
@@ -510,102 +1352,486 @@ def setup_R_script(h, w, b, label_dict):
                 'w': w,
                 'b': b,
                 'labels': ",".join(('"%s"="%s"' %(id,lab) for id,lab in label_dict.items())),
+                'data': data.path,
         })
         return s
 
-def median(lst):
-    quotient, remainder = divmod(len(lst), 2)
-    if remainder:
-        return sorted(lst)[quotient]
-    return sum(sorted(lst)[quotient - 1:quotient + 1]) / 2.
+def aggregate_density(tracks, aggr):
+        """Aggregate the density of the tracks of an overlay group position-wise,
+        with the mean or median of the tracks stacked into a 2-D array"""
+        aggr_f = {"mean": np.mean, "median": np.median}
+        return aggr_f[aggr](np.vstack([np.asarray(y, dtype=np.float64) for y in tracks]), axis=0)
 
-def mean(lst):
-        return sum(lst)/len(lst)
-
-
-def make_R_lists(id_list, d, overlay_dict, aggr, intersected_introns):
-        s = ""
-        aggr_f = {
-                "mean": mean,
-                "median": median,
-        }
+def plot_tracks(id_list, d, overlay_dict, aggr, smap, bin_size=1):
+        """Yield the plotted data of each sample, or of each overlay group: the
+        density runs (see rle_density) and the junctions, shrunk if smap is given"""
+        aggregate = aggr and "_j" not in aggr
         id_list = id_list if not overlay_dict else overlay_dict.keys()
         # Iterate over ids to get bam signal and junctions
-        shrinked_introns = dict()
         for k in id_list:
-                shrinked_introns_k, shrinked_intronsid = dict(), dict()
-                x, y, dons, accs, yd, ya, counts = [], [], [], [], [], [], []
+                dons, accs, yd, ya, counts = [], [], [], [], []
                 if not overlay_dict:
-                        x, y, dons, accs, yd, ya, counts = d[k]
-                        if intersected_introns:
-                                x, y = shrink_density(x, y, intersected_introns)
-                                shrinked_introns_k, dons, accs = shrink_junctions(dons, accs, intersected_introns)
-                                shrinked_introns.update(shrinked_introns_k)
+                        start, y, dons, accs, yd, ya, counts = d[k]
+                        if smap is not None:
+                                dons, accs = shrink_junctions(dons, accs, smap)
+                        x, y = density_xy(start, y, smap, bin_size)
                 else:
+                        xs, ys = [], []
                         for id in overlay_dict[k]:
-                                xid, yid, donsid, accsid, ydid, yaid, countsid = d[id]
-                                if intersected_introns:
-                                        xid, yid = shrink_density(xid, yid, intersected_introns)
-                                        shrinked_intronsid, donsid, accsid = shrink_junctions(donsid, accsid, intersected_introns)
-                                        shrinked_introns.update(shrinked_intronsid)
-                                x += xid
-                                y += yid
+                                startid, yid, donsid, accsid, ydid, yaid, countsid = d[id]
+                                if smap is not None:
+                                        donsid, accsid = shrink_junctions(donsid, accsid, smap)
+                                if not aggregate:
+                                        xid, yid = density_xy(startid, yid, smap, bin_size)
+                                        xs.append(xid)
+                                        ys.append(yid)
                                 dons += donsid
                                 accs += accsid
                                 yd += ydid
                                 ya += yaid
                                 counts += countsid
-                        if aggr and "_j" not in aggr:
-                                x = d[overlay_dict[k][0]][0]
-                                y = list(map(aggr_f[aggr], zip(*(d[id][1] for id in overlay_dict[k]))))
-                                if intersected_introns:
-                                        x, y = shrink_density(x, y, intersected_introns)
-                        #dons, accs, yd, ya, counts = [], [], [], [], []
+                        if aggregate:
+                                # All the tracks of a group span the same region
+                                start = d[overlay_dict[k][0]][0]
+                                y = aggregate_density([d[id][1] for id in overlay_dict[k]], aggr)
+                                x, y = density_xy(start, y, smap, bin_size)
+                        else:
+                                x, y = np.concatenate(xs), np.concatenate(ys)
+                xmin, xmax, y = rle_density(x, y, bin_size)
+                yield k, xmin, xmax, y, dons, accs, yd, ya, counts
+
+
+def junction_rows(dons, accs, yd, ya, counts, aggr=""):
+        """Group the junctions of a track by donor and acceptor, keeping the
+        maximum heights. With an aggregate function
+        (mean or median) the counts of a group are aggregated into one row;
+        otherwise each count gets its own row, labeled with all the counts of
+        the group. Return (don, acc, yd, ya, count, label) rows sorted by donor
+        and acceptor."""
+        aggr_f = {"mean": np.mean, "median": np.median}
+        groups = OrderedDict()
+        for j in zip(dons, accs, yd, ya, counts):
+                groups.setdefault(j[:2], []).append(j[2:])
+        rows = []
+        for (don, acc) in sorted(groups):
+                g_yd, g_ya, g_counts = zip(*groups[(don, acc)])
+                if aggr:
+                        count = int(round(aggr_f[aggr](g_counts)))
+                        rows.append((don, acc, max(g_yd), max(g_ya), count, str(count)))
+                        continue
+                label = ",".join(str(int(c)) for c in g_counts)
+                rows.extend((don, acc, max(g_yd), max(g_ya), c, label) for c in g_counts)
+        return rows
+
+
+def density_at(xmin, xmax, y, p, bin_start, bin_size):
+        """Return the plotted density at position p: the value of the bin of p,
+        or the maximum over overlaid tracks. 0 if no run covers the bin."""
+        q = bin_start + (p - bin_start) // bin_size * bin_size + (bin_size - 1) / 2.
+        covered = (xmin < q) & (q < xmax)
+        return y[covered].max() if covered.any() else 0
+
+
+def junction_arcs(rows, maxheight):
+        """Return the arcs drawn for the junction rows of a track as (don, acc,
+        yd, ya, xmid, ymid, lwd, label, top) tuples. Arcs alternate between the
+        top, where the apex is 1.2-1.5 times above the highest end, and the
+        bottom, 0.2-0.4 times maxheight below the axis. Heights are drawn from
+        a generator seeded with the mean height of the ends, so they do not
+        change between runs (nor between Python versions, which hash floats
+        differently)."""
+        total = float(sum(row[4] for row in rows)) or 1.
+        arcs = []
+        for i, (don, acc, yd, ya, count, label) in enumerate(rows):
+                rnd = random.Random(int((yd + ya) * 500))
+                ymid = max(yd, ya) * rnd.uniform(1.2, 1.5)
+                top = i % 2 == 0
+                if not top:
+                        ymid = -rnd.uniform(0.2, 0.4) * maxheight
+                # Widths from 0.1 to 4 (R lwd units) by share of the counts
+                lwd = count / total * (4 - 0.1) + 0.1
+                arcs.append((don, acc, yd, ya, round((don + acc) / 2., 1), ymid, lwd, label, top))
+        return arcs
+
+
+def plot_junctions(tracks, aggr, fix_y_scale, bin_start, bin_size):
+        """Return the junction arcs of each track (see junction_arcs), the
+        maximum density of each track, shared by all with fix_y_scale, and the
+        apex of the highest top arc. With an aggregate function (mean, median,
+        mean_j or median_j) arcs start at the plotted density next to the
+        donor and acceptor."""
+        aggr = aggr.rstrip("_j")
+        maxheights = [y.max() if len(y) else 0 for _, _, _, y, _, _, _, _, _ in tracks]
+        if fix_y_scale and tracks:
+                maxheights = [max(maxheights)] * len(tracks)
+        arcs = []
+        for (k, xmin, xmax, y, dons, accs, yd, ya, counts), maxheight in zip(tracks, maxheights):
+                rows = junction_rows(dons, accs, yd, ya, counts, aggr)
+                if aggr:
+                        rows = [(don, acc, density_at(xmin, xmax, y, don - 1, bin_start, bin_size), density_at(xmin, xmax, y, acc + 1, bin_start, bin_size), count, label)
+                                for don, acc, _, _, count, label in rows]
+                arcs.append(junction_arcs(rows, maxheight))
+        top = max([arc[5] for a in arcs for arc in a if arc[8]] or [0])
+        return arcs, maxheights, top
+
+
+def arc_paths(arcs, n=25):
+        """Return the points of the junction arcs as (arc index, x, y) arrays,
+        n per half arc. Each half is a quadratic curve from the junction end,
+        leaving it vertically, to the apex, reached horizontally; bottom arcs
+        start at 0."""
+        if not arcs:
+                return np.zeros(0, dtype=np.int64), np.zeros(0), np.zeros(0)
+        don, acc, yd, ya, xmid, ymid, top = (np.array([a[i] for a in arcs], dtype=np.float64) for i in (0, 1, 2, 3, 4, 5, 8))
+        yd, ya = yd * top, ya * top
+        t = np.linspace(0, 1, n)[:, None]
+        # Left half from the donor to the apex, then right half back to the acceptor
+        t = np.concatenate([t, t[::-1]])
+        x0 = np.concatenate([np.tile(don, (n, 1)), np.tile(acc, (n, 1))])
+        y0 = np.concatenate([np.tile(yd, (n, 1)), np.tile(ya, (n, 1))])
+        x = x0 + t**2 * (xmid - x0)
+        y = y0 + (1 - (1 - t)**2) * (ymid - y0)
+        # The apex exactly, which may set the upper limit of the y axis
+        x[n-1:n+1], y[n-1:n+1] = xmid, ymid
+        arc = np.tile(np.arange(len(arcs)), (2 * n, 1))
+        return arc.T.ravel(), x.T.ravel(), y.T.ravel()
+
+
+def make_R_lists(tracks, arcs, smap, data, bin_size=1):
+        s = ""
+        for (k, xmin, xmax, y, _, _, _, _, _), track_arcs in zip(tracks, arcs):
+                arc, arc_x, arc_y = arc_paths(track_arcs)
                 s += """
-                density_list[["%(id)s"]] = data.frame(x=c(%(x)s), y=c(%(y)s))
-                junction_list[["%(id)s"]] = data.frame(x=c(%(dons)s), xend=c(%(accs)s), y=c(%(yd)s), yend=c(%(ya)s), count=c(%(counts)s))
+                density_list[["%(id)s"]] = data.frame(xmin=%(xmin)s, xmax=%(xmax)s, y=%(y)s)
+                junction_list[["%(id)s"]] = list(
+                        arcs = data.frame(arc=%(arc)s, x=%(arc_x)s, y=%(arc_y)s, size=%(size)s),
+                        labels = data.frame(x=%(xmid)s, y=%(ymid)s, label=c(%(labels)s), stringsAsFactors=FALSE)
+                )
                 """ %({
                         'id': k,
-                        'x' : ",".join(map(str, x)),
-                        'y' : ",".join(map(str, y)),
-                        'dons' : ",".join(map(str, dons)),
-                        'accs' : ",".join(map(str, accs)),
-                        'yd' : ",".join(map(str, yd)),
-                        'ya' : ",".join(map(str, ya)),
-                        'counts' : ",".join(map(str, counts))
+                        'xmin' : data.column(xmin),
+                        'xmax' : data.column(xmax),
+                        'y' : data.column(y),
+                        'arc' : data.column(arc),
+                        'arc_x' : data.column(arc_x),
+                        'arc_y' : data.column(arc_y),
+                        # ggplot2 line sizes are in mm, arc widths in R lwd units
+                        'size' : data.column(np.array([a[6] for a in track_arcs])[arc] / (72.27 / 25.4)),
+                        'xmid' : data.column([a[4] for a in track_arcs]),
+                        'ymid' : data.column([a[5] for a in track_arcs]),
+                        'labels' : ",".join('"%s"' % a[7] for a in track_arcs),
                 })
-        if intersected_introns:
-                s+= """
-                coord_dict = data.frame(shrinked=c(%(shrinked_introns_keys)s), real=c(%(shrinked_introns_values)s))
-                intersected_introns = data.frame(real_x=c(%(intersected_introns_x)s), real_xend=c(%(intersected_introns_xend)s))
+        if smap is not None:
+                # Breaks of the shrunk axis, labeled with the real coordinates
+                breaks, labels = shrunk_axis_breaks(tracks, smap, bin_size)
+                s += """
+                breaks_x_shrinked = %(breaks)s
+                breaks_x = %(labels)s
                 """ %({
-                        'shrinked_introns_keys': ','.join(map(str, shrinked_introns.keys())),
-                        'shrinked_introns_values': ','.join(map(str, shrinked_introns.values())),
-                        'intersected_introns_x': ','.join([str(coord[0]) for coord in intersected_introns]),
-                        'intersected_introns_xend': ','.join([str(coord[1]) for coord in intersected_introns])
+                        'breaks': data.column(breaks),
+                        'labels': data.column(labels),
                 })
         return s
 
 
-def plot(R_script):
-        p = sp.Popen("R --vanilla --slave", shell=True, stdin=sp.PIPE)
-        p.communicate(input=R_script.encode('utf-8'))
-        p.stdin.close()
-        p.wait()
+class RData(object):
+        """Binary file with the numeric columns of the tables built by the R script.
+        Columns are stored one after the other as little-endian int32 or float64
+        values, and read back in R by offset with read_column."""
+
+        def __init__(self, path):
+                self.path = path
+                self.f = open(path, "wb")
+                self.offset = 0
+
+        def column(self, values):
+                """Write a column and return the R expression that reads it"""
+                a = np.asarray(values)
+                if a.dtype.kind in "biu":
+                        a, type = a.astype("<i4"), "integer"
+                else:
+                        a, type = a.astype("<f8"), "double"
+                self.f.write(a.tobytes())
+                expr = 'read_column("%s", %d, %d)' %(type, self.offset, len(a))
+                self.offset += a.nbytes
+                return expr
+
+        def close(self):
+                self.f.close()
+
+
+def plot(R_script, pool=None, files=(), metrics=None, output=None):
+        """Render R_script, in the background if a pool is given. Return the
+        future of the background render, None otherwise."""
+        if pool is not None:
+                return pool.submit(R_script, files, metrics, output)
+        metrics = metrics if metrics is not None else Metrics()
+        with metrics.timer("render", output=output):
+                p = sp.Popen("R --vanilla --slave", shell=True, stdin=sp.PIPE)
+                p.communicate(input=R_script.encode('utf-8'))
+                p.stdin.close()
+                p.wait()
+        for f in files:
+                os.remove(f)
         return
 
 
-def colorize(d, p, color_factor):
+R_WORKER_DONE = "__ggsashimi_done__"
+# Seconds an R worker may go without output while rendering before it is killed
+R_WORKER_TIMEOUT = 600
+
+# Main loop of the R worker: load the libraries once, then source each script
+# whose path is received on stdin in a fresh environment. An empty line stops it.
+# The end of each script is marked on a line of its own, even after output
+# without a trailing newline.
+R_WORKER_LOOP = "; ".join([
+        "suppressMessages({library(ggplot2); library(grid); library(gridExtra); library(data.table); library(gtable)})",
+        "con = file('stdin', open='r')",
+        "while (length(f <- readLines(con, n=1)) > 0 && nzchar(f)) {"
+                " tryCatch(source(f, local=new.env()), error=function(e) message('ERROR: ', conditionMessage(e)));"
+                " graphics.off();"
+                " cat('\\n%s\\n'); flush(stdout())"
+        " }" % R_WORKER_DONE,
+])
+
+
+class RWorker(object):
+        """Long-lived R process rendering the scripts sent over a pipe. A worker
+        without output for R_WORKER_TIMEOUT seconds while rendering is killed."""
+
+        def __init__(self):
+                self.process = sp.Popen(["R", "--vanilla", "--slave", "-e", R_WORKER_LOOP],
+                        stdin=sp.PIPE, stdout=sp.PIPE, universal_newlines=True)
+                self.timeout = R_WORKER_TIMEOUT
+                # Output is read by a thread of its own, so that reads can time out
+                self.lines = Queue()
+                reader = threading.Thread(target=self.read_output)
+                reader.daemon = True
+                reader.start()
+
+        def read_output(self):
+                for line in iter(self.process.stdout.readline, ""):
+                        self.lines.put(line)
+                self.lines.put("")
+
+        def is_alive(self):
+                return self.process.poll() is None
+
+        def run(self, R_script):
+                with tempfile.NamedTemporaryFile("w", suffix=".R", delete=False) as f:
+                        f.write(R_script)
+                try:
+                        self.process.stdin.write(f.name + "\n")
+                        self.process.stdin.flush()
+                        # Forward R output until the script is done. The line before
+                        # the marker ends with the newline the marker starts with
+                        previous = None
+                        for line in iter(self.readline, ""):
+                                if line.rstrip("\n").endswith(R_WORKER_DONE):
+                                        if previous not in (None, "\n"):
+                                                sys.stdout.write(previous)
+                                        break
+                                if previous is not None:
+                                        sys.stdout.write(previous)
+                                previous = line
+                        else:
+                                sys.stdout.write(previous or "")
+                                raise RuntimeError("R worker exited")
+                finally:
+                        os.remove(f.name)
+
+        def readline(self):
+                try:
+                        return self.lines.get(timeout=self.timeout)
+                except Empty:
+                        # The next script is rendered by a new worker (see RPool.run)
+                        self.process.kill()
+                        self.process.wait()
+                        raise RuntimeError("no output from R for {} s, worker killed".format(self.timeout))
+
+        def close(self):
+                if self.is_alive():
+                        self.process.stdin.write("\n")
+                        self.process.stdin.close()
+                self.process.wait()
+
+
+class RPool(object):
+        """Pool of n persistent R workers. Each rendering thread starts its own
+        worker on first use and reuses it for all subsequent plots."""
+
+        def __init__(self, n=1):
+                self.executor = ThreadPoolExecutor(max_workers=n)
+                self.local = threading.local()
+                self.lock = threading.Lock()
+                self.workers = []
+                # Bound the number of scripts held in memory waiting for a worker
+                self.slots = threading.BoundedSemaphore(2 * n)
+
+        def run(self, R_script, files=(), metrics=None, output=None):
+                metrics = metrics if metrics is not None else Metrics()
+                try:
+                        worker = getattr(self.local, "worker", None)
+                        if worker is None or not worker.is_alive():
+                                worker = self.local.worker = RWorker()
+                                with self.lock:
+                                        self.workers.append(worker)
+                        with metrics.timer("render", output=output):
+                                worker.run(R_script)
+                except Exception as e:
+                        print("ERROR: R rendering failed: {}".format(e))
+                finally:
+                        for f in files:
+                                os.remove(f)
+                        self.slots.release()
+
+        def submit(self, R_script, files=(), metrics=None, output=None):
+                self.slots.acquire()
+                return self.executor.submit(self.run, R_script, files, metrics, output)
+
+        def close(self):
+                self.executor.shutdown(wait=True)
+                for worker in self.workers:
+                        worker.close()
+
+
+def color_list(d, p, color_factor):
+        """Return the color of each id, from the palette p by color level if
+        color_factor is set, grey otherwise"""
         levels = list(OrderedDict.fromkeys(d.values()).keys())
         n = len(levels)
         if n > len(p):
                 p = (p*n)[:n]
         if color_factor:
-                s = "color_list = list(%s)\n" %( ",".join('"%s"="%s"' %(k, p[levels.index(v)]) for k,v in d.items()) )
-        else:
-                s = "color_list = list(%s)\n" %( ",".join('"%s"="%s"' %(k, "grey") for k,v in d.items()) )
+                return OrderedDict((k, p[levels.index(v)]) for k,v in d.items())
+        return OrderedDict((k, "grey") for k in d)
+
+def colorize(d, p, color_factor):
+        s = "color_list = list(%s)\n" %( ",".join('"%s"="%s"' %(k, v) for k,v in color_list(d, p, color_factor).items()) )
         return s
 
+def sampling_caption(sample_fraction, max_reads, fractions):
+        """Caption of the plots of subsampled reads, empty if no sample was
+        subsampled. fractions are those of the reads used of each sample (see
+        read_bam)."""
+        fractions = list(fractions)
+        sampled = []
+        if sample_fraction < 1 and any(fraction < 1 for fraction in fractions):
+                sampled.append("{:g}% of the reads".format(sample_fraction * 100))
+        # Only the samples with more than max_reads reads are subsampled
+        if max_reads and any(fraction < sample_fraction for fraction in fractions):
+                sampled.append("at most {} reads per sample".format(max_reads))
+        if not sampled:
+                return ""
+        return "Coverage and junction counts estimated from " + ", ".join(sampled)
+
+def render_matplotlib(tracks, arcs, maxheights, top, annotation, colors, labels, smap, bin_size, output, args, caption=""):
+        """Render a plot with matplotlib instead of R, with the same layout: a
+        density track with junction arcs per sample (or overlay group) sharing
+        the x axis, the annotation and the caption, if any, below. tracks are
+        the items of plot_tracks, arcs, maxheights and top the output of
+        plot_junctions and annotation that of make_introns, or None."""
+        import matplotlib.colors
+        # A figure of its own rather than pyplot, which would change the backend
+        # and global state of the calling process (and its other threads)
+        from matplotlib.figure import Figure
+        from matplotlib.backends.backend_agg import FigureCanvasAgg
+        from matplotlib.collections import LineCollection, PolyCollection
+
+        # ggplot2 line widths are in 1/96 inch and sizes in mm
+        lwd_pt, mm_pt = 72 / 96., 72.27 / 25.4
+
+        n = len(tracks)
+        heights = [args.height] * n + ([args.ann_height] if annotation is not None else [])
+        fig = Figure(figsize=(args.width, sum(heights) + 0.5 + (0.3 if caption else 0)), constrained_layout=True)
+        grid = fig.add_gridspec(len(heights), 1, height_ratios=heights)
+        axes = []
+        for i, (k, xmin, xmax, y, _, _, _, _, _) in enumerate(tracks):
+                ax = fig.add_subplot(grid[i], sharex=axes[0] if axes else None)
+                axes.append(ax)
+                color = colors[k] if matplotlib.colors.is_color_like(colors[k]) else "grey"
+                # Runs of equal coverage as bars, leaving out empty ones
+                drawn = y > 0
+                verts = np.stack([
+                        np.column_stack((xmin[drawn], np.zeros(drawn.sum()))),
+                        np.column_stack((xmin[drawn], y[drawn])),
+                        np.column_stack((xmax[drawn], y[drawn])),
+                        np.column_stack((xmax[drawn], np.zeros(drawn.sum()))),
+                ], axis=1)
+                ax.add_collection(PolyCollection(verts, facecolors=color, edgecolors="none", alpha=args.alpha))
+
+                # As in the R script, the y range spans the density and the label
+                # apexes only, whatever the extent of the arc paths
+                ymin, ymax = 0, maxheights[i]
+                if arcs[i]:
+                        arc, arc_x, arc_y = arc_paths(arcs[i])
+                        paths = np.split(np.column_stack((arc_x, arc_y)), np.flatnonzero(np.diff(arc)) + 1)
+                        ax.add_collection(LineCollection(paths, colors=color, linewidths=[a[6] * lwd_pt for a in arcs[i]], clip_on=False))
+                for don, acc, yd, ya, xmid, ymid, lwd, label, is_top in arcs[i]:
+                        ax.text(xmid, ymid, label, ha="center", va="center", fontsize=args.base_size * 0.6,
+                                bbox=dict(facecolor="white", edgecolor="none", pad=0.5))
+                        ymin, ymax = min(ymin, ymid), max(ymax, ymid)
+                if args.fix_y_scale:
+                        ymax = max(maxheights[i], top)
+                pad = 0.05 * (ymax - ymin) or 0.5
+                ax.set_ylim(ymin - pad, ymax + pad)
+                ax.set_yticks(sorted(set(b for b in extended_breaks(0, maxheights[i], 4) if 0 <= b <= ymax + pad)))
+
+                ax.set_ylabel(labels[k], rotation=0, ha="right", va="center", fontsize=args.base_size)
+                ax.tick_params(labelsize=args.base_size * 0.8)
+                for side in ("top", "right"):
+                        ax.spines[side].set_visible(False)
+                for side in ("left", "bottom"):
+                        ax.spines[side].set_linewidth(0.5 * mm_pt)
+                # Only the last density track keeps the x axis
+                if i < n - 1:
+                        ax.spines["bottom"].set_visible(False)
+                        ax.tick_params(axis="x", bottom=False, labelbottom=False)
+
+        # Plotted x range, as in the R script
+        left = min([t[1].min() for t in tracks if len(t[1])] or [0])
+        right = max([t[2].max() for t in tracks if len(t[2])] or [1])
+        if axes:
+                axes[0].set_xlim(left - 0.25, right + 0.25)
+                last = axes[-1]
+                # Label the shrunk axis with the real coordinates
+                if smap is not None:
+                        ticks, real = shrunk_axis_breaks(tracks, smap, bin_size)
+                else:
+                        ticks = real = [b for b in extended_breaks(left, right, 5) if left <= b <= right]
+                last.set_xticks(ticks)
+                last.set_xticklabels(["%d" % round(b) for b in real])
+
+        if annotation is not None:
+                ax = fig.add_subplot(grid[n], sharex=axes[0] if axes else None)
+                txs = sorted(set(annotation["exons"]) | set(annotation["introns"]))
+                ty = dict((tx, i) for i, tx in enumerate(txs))
+                arrow_space = max(1, int((right - left) / 50))
+                for tx, introns in annotation["introns"].items():
+                        for start, end, strand in introns:
+                                ax.plot([start, end], [ty[tx]] * 2, color="black", linewidth=0.3 * mm_pt, solid_capstyle="butt")
+                                # Strand arrows along the intron
+                                if end - start > 5:
+                                        marker = ">" if strand == '"+"' else "<"
+                                        xs = range(start + 4, end, arrow_space) if marker == ">" else range(start, max(start + 1, end - 4), arrow_space)
+                                        ax.plot(list(xs), [ty[tx]] * len(xs), linestyle="none", marker=marker, markersize=4, color="black")
+                for tx, exons in annotation["exons"].items():
+                        for start, end, strand in exons:
+                                ax.plot([start, end], [ty[tx]] * 2, color="black", linewidth=5 * mm_pt, solid_capstyle="butt")
+                ax.set_ylim(-0.5, len(txs) - 0.5)
+                ax.set_yticks(range(len(txs)))
+                ax.set_yticklabels([tx.strip('"') for tx in txs], fontsize=args.base_size * 0.8)
+                ax.tick_params(left=False, bottom=False, labelbottom=False)
+                for spine in ax.spines.values():
+                        spine.set_visible(False)
+
+        save_options = dict(pil_kwargs={"compression": "tiff_lzw"}) if args.out_format == "tiff" else dict()
+        if caption:
+                fig.supxlabel(caption, fontsize=args.base_size * 0.6)
+        FigureCanvasAgg(fig)
+        fig.savefig(output, format=args.out_format, dpi=args.out_resolution, **save_options)
+
+
 def get_debug_info():
         """
         Return useful debug information:
@@ -646,48 +1872,56 @@ def get_debug_info():
         r_info = sp.check_output(r_command, shell=True, stderr=sp.STDOUT)
         print(r_info.strip().decode('utf-8'))
 
+strand_dict = {"plus": "+", "minus": "-"}
 
-if __name__ == "__main__":
-
-        strand_dict = {"plus": "+", "minus": "-"}
-
-        parser = define_options()
-        if len(sys.argv)==1:
-            parser.print_help()
-            sys.exit(1)
-        args = parser.parse_args()
-
-#       args.coordinates = "chrX:9609491-9612406"
-#       args.coordinates = "chrX:9609491-9610000"
-#       args.bam = "/nfs/no_backup/rg/epalumbo/projects/tg/work/8b/8b0ac8705f37fd772a06ab7db89f6b/2A_m4_n10_toGenome.bam"
-
-        if args.aggr and not args.overlay:
-                print("ERROR: Cannot apply aggregate function if overlay is not selected.")
-                exit(1)
-
-        palette = read_palette(args.palette)
 
+def read_regions(f):
+        """Read regions from a BED file. Yield the region name (4th column, when
+        present) and its coordinates in the chr:start-end format."""
+        with open(f) as openf:
+                for line in openf:
+                        if not line.strip() or line.startswith(("#", "track", "browser")):
+                                continue
+                        line_sp = line.rstrip("\n").split("\t")
+                        chr, start, end = line_sp[0], int(line_sp[1]), int(line_sp[2])
+                        name = line_sp[3] if len(line_sp) > 3 and line_sp[3] else "%s_%s_%s" %(chr, start, end)
+                        # BED start is 0-based
+                        yield name, "%s:%s-%s" %(chr, start + 1, end)
+
+
+def get_out_prefix(out_prefix, out_format):
+        """Split the output file name into prefix and suffix (allow tiff/tif and jpeg/jpg extensions)"""
+        if out_prefix.endswith(('.pdf', '.png', '.svg', '.tiff', '.tif', '.jpeg', '.jpg')):
+                out_split = os.path.splitext(out_prefix)
+                if (out_format == out_split[1][1:] or
+                out_format == 'tiff' and out_split[1] in ('.tiff','.tif') or
+                out_format == 'jpeg' and out_split[1] in ('.jpeg','.jpg')):
+                        return out_split[0], out_split[1][1:]
+        return out_prefix, out_format
+
+
+def collect_tracks(samples, coverages, c, args):
+        """Prepare signal and junctions of each sample in region c for plotting"""
         bam_dict, overlay_dict, color_dict, id_list, label_dict = {"+":OrderedDict()}, OrderedDict(), OrderedDict(), [], OrderedDict()
+        sample_fractions = OrderedDict()
         if args.strand != "NONE": bam_dict["-"] = OrderedDict()
-        if args.junctions_bed != "": junctions_list = []
+        junctions_list = []
 
-        for id, bam, overlay_level, color_level, label_text in read_bam_input(args.bam, args.overlay, args.color_factor, args.labels):
-                if not os.path.isfile(bam):
-                        continue
-                a, junctions = read_bam(bam, args.coordinates, args.strand)
-                if a.keys() == ["+"] and all(map(lambda x: x==0, list(a.values()[0]))):
+        for (id, bam, overlay_level, color_level, label_text), (a, junctions, fraction) in zip(samples, coverages):
+                if not any(y.any() for y in a.values()):
                         print("WARN: Sample {} has no reads in the specified area.".format(id))
                         continue
                 id_list.append(id)
                 label_dict[id] = label_text
+                sample_fractions[id] = fraction
                 for strand in a:
                         # Store junction information
                         if args.strand == "NONE" or args.out_strand == 'both' or strand == strand_dict[args.out_strand]:
                                 if args.junctions_bed:
                                         for k,v in zip(junctions[strand].keys(), junctions[strand].values()):
                                                 if v >= args.min_coverage:
-                                                        junctions_list.append('\t'.join([args.coordinates.split(':')[0], str(k[0]), str(k[1]), id, str(v), strand]))
-                        bam_dict[strand][id] = prepare_for_R(a[strand], junctions[strand], args.coordinates, args.min_coverage)
+                                                        junctions_list.append('\t'.join([c.split(':')[0], str(k[0]), str(k[1]), id, str(v), strand]))
+                        bam_dict[strand][id] = prepare_for_R(a[strand], junctions[strand], c, args.min_coverage)
                 if color_level is None:
                         color_dict.setdefault(id, id)
                 if overlay_level is not None:
@@ -697,54 +1931,64 @@ if __name__ == "__main__":
                 if overlay_level is None:
                         color_dict.setdefault(id, color_level)
 
-        # No bam files
-        if not bam_dict["+"]:
-                print("ERROR: No available bam files.")
-                exit(1)
+        return bam_dict, overlay_dict, color_dict, id_list, label_dict, junctions_list, sample_fractions
 
-        # Write junctions to BED
-        if args.junctions_bed:
-                if not args.junctions_bed.endswith('.bed'):
-                        args.junctions_bed = args.junctions_bed + '.bed'
-                jbed = open(args.junctions_bed, 'w')
-                jbed.write('\n'.join(sorted(junctions_list)))
-                jbed.close()
 
-        if args.gtf:
-                transcripts, exons = read_gtf(args.gtf, args.coordinates)
-
-        if args.out_format not in ('pdf', 'png', 'svg', 'tiff', 'jpeg'):
-                print("ERROR: Provided output format '%s' is not available. Please select among 'pdf', 'png', 'svg', 'tiff' or 'jpeg'" % args.out_format)
-                exit(1)
+def plot_region(bam_dict, overlay_dict, color_dict, id_list, label_dict, transcripts, exons, palette, out_prefix, out_suffix, args, pool=None, metrics=None, sample_fractions=None):
+        """Generate the R script for each strand of a region and render it.
+        Return the (output, future) pairs of the plots, where future is that of
+        the background render by the pool, or None if already rendered.
+        sample_fractions are the fractions of the reads used of each sample,
+        noted below the plots if any is below 1."""
+        metrics = metrics if metrics is not None else Metrics()
+        plots = []
+        caption = sampling_caption(args.sample_fraction, args.max_reads, (sample_fractions or {}).values())
 
         # Iterate for plus and minus strand
         for strand in bam_dict:
 
-                # Output file name (allow tiff/tif and jpeg/jpg extensions)
-                if args.out_prefix.endswith(('.pdf', '.png', '.svg', '.tiff', '.tif', '.jpeg', '.jpg')):
-                        out_split = os.path.splitext(args.out_prefix)
-                        if (args.out_format == out_split[1][1:] or
-                        args.out_format == 'tiff' and out_split[1] in ('.tiff','.tif') or
-                        args.out_format == 'jpeg' and out_split[1] in ('.jpeg','.jpg')):
-                                args.out_prefix = out_split[0]
-                                out_suffix = out_split[1][1:]
-                        else:
-                                out_suffix = args.out_format
-                else:
-                        out_suffix = args.out_format
-                out_prefix = args.out_prefix + "_" + strand
                 if args.strand == "NONE":
-                        out_prefix = args.out_prefix
+                        strand_prefix = out_prefix
                 else:
+                        strand_prefix = out_prefix + "_" + strand
                         if args.out_strand != "both" and strand != strand_dict[args.out_strand]:
                                 continue
+                output = "%s.%s" % (strand_prefix, out_suffix)
 
-                # Find set of junctions to perform shrink
-                intersected_introns = None
+                # Find set of junctions to perform shrink, and the map to shrunk coordinates
+                smap = None
                 if args.shrink:
-                        introns = (v for vs in bam_dict[strand].values() for v in zip(vs[2], vs[3]))
-                        intersected_introns = list(intersect_introns(introns))
+                        with metrics.timer("shrink", output=output):
+                                introns = (v for vs in bam_dict[strand].values() for v in zip(vs[2], vs[3]))
+                                intersected_introns = list(intersect_introns(introns))
+                                if intersected_introns:
+                                        smap = shrink_map(intersected_introns)
+
 
+                # Plotted x axis (shrunk if required)
+                start, y = list(bam_dict[strand].values())[0][:2]
+                x = [start, start + len(y) - 1]
+                if smap is not None:
+                        x = shrink_coordinates(x, smap)[0].tolist()
+
+                # Summarize the density in bins of about one pixel of the output
+                bin_size = args.bin_size or int(math.ceil(float(x[-1] - x[0] + 1) / (args.width * args.out_resolution)))
+
+                # Make introns from annotation (they are shrunk if required)
+                annotation = make_introns(transcripts, exons, smap) if args.gtf else None
+
+                script_start = metrics.begin()
+
+                # Density and junction arcs of each track
+                tracks = list(plot_tracks(id_list, bam_dict[strand], overlay_dict, args.aggr, smap, bin_size))
+                arcs, maxheights, top = plot_junctions(tracks, args.aggr, args.fix_y_scale, x[0], bin_size)
+
+                if args.engine == "matplotlib":
+                        render_matplotlib(tracks, arcs, maxheights, top, annotation, color_list(color_dict, palette, args.color_factor),
+                                label_dict, smap, bin_size, output, args, caption)
+                        metrics.finish("render", script_start, OrderedDict([("output", output)]))
+                        plots.append((output, None))
+                        continue
 
                 # *** PLOT *** Define plot height
                 bam_height = args.height * len(id_list)
@@ -753,22 +1997,26 @@ if __name__ == "__main__":
                 if args.gtf:
                         bam_height += args.ann_height
 
+                # Numeric data is handed to R through a binary file
+                debug = os.getenv('GGSASHIMI_DEBUG') is not None
+                if debug:
+                        data = RData(os.path.abspath("R_data"))
+                else:
+                        fd, data_path = tempfile.mkstemp(suffix=".bin")
+                        os.close(fd)
+                        data = RData(data_path)
+
                 # *** PLOT *** Start R script by loading libraries, initializing variables, etc...
-                R_script = setup_R_script(bam_height, args.width, args.base_size, label_dict)
+                R_script = setup_R_script(bam_height, args.width, args.base_size, label_dict, data)
 
                 R_script += colorize(color_dict, palette, args.color_factor)
 
                 # *** PLOT *** Prepare annotation plot only for the first bam file
                 arrow_bins = 50
                 if args.gtf:
-                        # Make introns from annotation (they are shrunk if required)
-                        annotation = make_introns(transcripts, exons, intersected_introns)
-                        x = list(bam_dict[strand].values())[0][0]
-                        if args.shrink:
-                                x, _ = shrink_density(x, x, intersected_introns)
-                        R_script += gtf_for_ggplot(annotation, x[0], x[-1], arrow_bins)
+                        R_script += gtf_for_ggplot(annotation, x[0], x[-1], arrow_bins, data)
 
-                R_script += make_R_lists(id_list, bam_dict[strand], overlay_dict, args.aggr, intersected_introns)
+                R_script += make_R_lists(tracks, arcs, smap, data, bin_size)
 
                 R_script += """
 
@@ -779,97 +2027,20 @@ if __name__ == "__main__":
                 } else {
                         vs = 0
                 }
+                # Junction arcs are drawn with their width in mm
+                if(packageVersion('ggplot2') >= '3.4.0'){
+                        arc_aes = aes(x=x, y=y, group=arc, linewidth=size)
+                        arc_scale = scale_linewidth_identity()
+                } else {
+                        arc_aes = aes(x=x, y=y, group=arc, size=size)
+                        arc_scale = scale_size_identity()
+                }
 
                 if(%(fix_y_scale)s) {
-
-                        maxheight = max(unlist(lapply(density_list, function(df){max(df$y)})))
+                        # Highest density and top arc of all the tracks
+                        maxheight = %(maxheight)s
+                        maxheight_j = %(maxheight_j)s
                         breaks_y = labeling::extended(0, maxheight, m = 4)
-                        maxheight_j = 0
-                        for (bam_index in 1:length(density_list)) { # Emulate code below to obtain max top arch height
-
-                                id = names(density_list)[bam_index]
-                                d = data.table(density_list[[id]])
-                                junctions = data.table(junction_list[[id]])
-
-                                row_i = c()
-                                if (nrow(junctions) >0 ) {
-                                        junctions$jlabel = as.character(junctions$count)
-                                        junctions = setNames(junctions[,.(max(y), max(yend),round(%(args.aggr)s(count)),paste(jlabel,collapse=",")), keyby=.(x,xend)], names(junctions))
-                                        if ("%(args.aggr)s" != "") {
-                                                junctions = setNames(junctions[,.(max(y), max(yend),round(%(args.aggr)s(count)),round(%(args.aggr)s(count))), keyby=.(x,xend)], names(junctions))
-                                        }
-                                        row_i = 1:nrow(junctions)
-                                }
-                                for (i in row_i) {
-                                        j = as.numeric(junctions[i,1:5])
-                                        if ("%(args.aggr)s" != "") {
-                                                j[3] = ifelse(length(d[x==j[1]-1,y])==0, 0, max(as.numeric(d[x==j[1]-1,y])))
-                                                j[4] = ifelse(length(d[x==j[2]+1,y])==0, 0, max(as.numeric(d[x==j[2]+1,y])))
-                                        }
-                                        if (i%%%%2 != 0) { #top
-                                                set.seed(mean(j[3:4]))
-                                                maxheight_j = max(maxheight_j, max(j[3:4]) * runif(1, 1.2, 1.5))
-                                        }
-                                }
-                        }
-                }
-
-                if(exists('coord_dict')){
-                        all_pos_shrinked = do.call(rbind, density_list)$x
-                        s2r = merge(intersected_introns, coord_dict, by.x = 'real_xend', by.y = 'real')
-                        s2r = merge(s2r, coord_dict, by.x = 'real_x', by.y = 'real', suffixes = c('_xend', '_x'))
-                        breaks_x_shrinked = labeling::extended(min(all_pos_shrinked), max(all_pos_shrinked), m = 5)
-                        breaks_x = c()
-                        out_range = c()
-                        for (b in breaks_x_shrinked){
-                                iintron = FALSE
-                                for (j in 1:nrow(s2r)){
-                                        l = s2r[j, ]
-                                        if(b >= l$shrinked_x && b <= l$shrinked_xend){
-                                                # Intersected intron
-                                                p = (b-l$shrinked_x)/(l$shrinked_xend - l$shrinked_x)
-                                                realb = round(l$real_x + p*(l$real_xend - l$real_x))
-                                                breaks_x = c(breaks_x, realb)
-                                                iintron = TRUE
-                                                break
-                                        }
-                                }
-                                if (!iintron){
-                                        # Exon, upstream/downstream intergenic region or intron (not intersected)
-                                        if(b <= min(s2r$shrinked_x)) {
-                                                l <- s2r[which.min(s2r$shrinked_x), ]
-                                                if(any(b == all_pos_shrinked)){
-                                                        # Boundary (subtract)
-                                                        s = l$shrinked_x - b
-                                                        realb = l$real_x - s
-                                                        breaks_x = c(breaks_x, realb)
-                                                } else {
-                                                        out_range <- c(out_range, which(breaks_x_shrinked == b))
-                                                }
-                                        } else if (b >= max(s2r$shrinked_xend)){
-                                                l <- s2r[which.max(s2r$shrinked_xend), ]
-                                                if(any(b == all_pos_shrinked)){
-                                                        # Boundary (sum)
-                                                        s = b - l$shrinked_xend
-                                                        realb = l$real_xend + s
-                                                        breaks_x = c(breaks_x, realb)
-                                                } else {
-                                                        out_range <- c(out_range, which(breaks_x_shrinked == b))
-                                                }
-                                        } else {
-                                                delta = b-s2r$shrinked_xend
-                                                delta[delta < 0] = Inf
-                                                l = s2r[which.min(delta), ]
-                                                # Internal (sum)
-                                                s = b - l$shrinked_xend
-                                                realb = l$real_xend + s
-                                                breaks_x = c(breaks_x, realb)
-                                        }
-                                }
-                        }
-                        if(length(out_range)) {
-                                breaks_x_shrinked = breaks_x_shrinked[-out_range]
-                        }
                 }
 
                 density_grobs = list();
@@ -878,96 +2049,36 @@ if __name__ == "__main__":
 
                         id = names(density_list)[bam_index]
                         d = data.table(density_list[[id]])
-                        junctions = data.table(junction_list[[id]])
 
                         # Density plot
-                        gp = ggplot(d) + geom_bar(aes(x, y), width=1, position='identity', stat='identity', fill=color_list[[id]], alpha=%(alpha)s)
+                        gp = ggplot(d) + geom_rect(aes(xmin=xmin, xmax=xmax, ymin=0, ymax=y), fill=color_list[[id]], alpha=%(alpha)s)
                         gp = gp + labs(y=labels[[id]])
-                        if(exists('coord_dict')) {
+                        if(exists('breaks_x')) {
                                 gp = gp + scale_x_continuous(expand=c(0, 0.25), breaks = breaks_x_shrinked, labels = breaks_x)
                         } else {
                                 gp = gp + scale_x_continuous(expand=c(0, 0.25))
                         }
 
+                        # Junction arcs and their labels, placed in Python
+                        junctions = junction_list[[id]]
+
+                        # The y range spans the density and the label apexes only, so
+                        # that the arc paths drawn below never widen it
+                        ylim = range(c(0, d[['y']], junctions$labels$y))
                         if(!%(fix_y_scale)s){
                                 maxheight = max(d[['y']])
                                 breaks_y = labeling::extended(0, maxheight, m = 4)
-                                gp = gp + scale_y_continuous(breaks = breaks_y)
                         } else {
-                                gp = gp + scale_y_continuous(breaks = breaks_y, limits = c(NA, max(maxheight, maxheight_j)))
+                                ylim[2] = max(maxheight, maxheight_j)
                         }
-
-                        # Aggregate junction counts
-                        row_i = c()
-                        if (nrow(junctions) >0 ) {
-
-                                junctions$jlabel = as.character(junctions$count)
-                                junctions = setNames(junctions[,.(max(y), max(yend),round(%(args.aggr)s(count)),paste(jlabel,collapse=",")), keyby=.(x,xend)], names(junctions))
-                                if ("%(args.aggr)s" != "") {
-                                        junctions = setNames(junctions[,.(max(y), max(yend),round(%(args.aggr)s(count)),round(%(args.aggr)s(count))), keyby=.(x,xend)], names(junctions))
-                                }
-                                # The number of rows (unique junctions per bam) has to be calculated after aggregation
-                                row_i = 1:nrow(junctions)
-                        }
-
-
-                        for (i in row_i) {
-
-                                j_tot_counts = sum(junctions[['count']])
-
-                                j = as.numeric(junctions[i,1:5])
-
-                                if ("%(args.aggr)s" != "") {
-                                        j[3] = ifelse(length(d[x==j[1]-1,y])==0, 0, max(as.numeric(d[x==j[1]-1,y])))
-                                        j[4] = ifelse(length(d[x==j[2]+1,y])==0, 0, max(as.numeric(d[x==j[2]+1,y])))
-                                }
-
-                                # Find intron midpoint
-                                xmid = round(mean(j[1:2]), 1)
-                                set.seed(mean(j[3:4]))
-                                ymid = max(j[3:4]) * runif(1, 1.2, 1.5)
-
-                                # Thickness of the arch
-                                lwd = scale_lwd(j[5]/j_tot_counts)
-
-                                curve_par = gpar(lwd=lwd, col=color_list[[id]])
-
-                                # Arc grobs
-
-                                # Choose position of the arch (top or bottom)
-                                nss = i
-                                if (nss%%%%2 == 0) {  #bottom
-                                        ymid = -runif(1, 0.2, 0.4) * maxheight
-                                        # Draw the arcs
-                                        # Left
-                                        curve = xsplineGrob(x=c(0, 0, 1, 1), y=c(1, 0, 0, 0), shape=1, gp=curve_par)
-                                        gp = gp + annotation_custom(grob = curve, j[1], xmid, 0, ymid)
-                                        # Right
-                                        curve = xsplineGrob(x=c(1, 1, 0, 0), y=c(1, 0, 0, 0), shape=1, gp=curve_par)
-                                        gp = gp + annotation_custom(grob = curve, xmid, j[2], 0, ymid)
-                                }
-
-                                if (nss%%%%2 != 0) {  #top
-                                        # Draw the arcs
-                                        # Left
-                                        curve = xsplineGrob(x=c(0, 0, 1, 1), y=c(0, 1, 1, 1), shape=1, gp=curve_par)
-                                        gp = gp + annotation_custom(grob = curve, j[1], xmid, j[3], ymid)
-                                        # Right
-                                        curve = xsplineGrob(x=c(1, 1, 0, 0), y=c(0, 1, 1, 1), shape=1, gp=curve_par)
-                                        gp = gp + annotation_custom(grob = curve, xmid, j[2], j[4], ymid)
-                                }
-
-                                # Add junction labels
-                                gp = gp + annotate("label", x = xmid, y = ymid, label = as.character(junctions[i,6]),
+                        gp = gp + scale_y_continuous(breaks = breaks_y)
+                        gp = gp + coord_cartesian(ylim = ylim, clip = "off")
+                        if (nrow(junctions$labels) > 0) {
+                                gp = gp + geom_path(data=junctions$arcs, mapping=arc_aes, colour=color_list[[id]]) + arc_scale
+                                gp = gp + geom_label(data=junctions$labels, aes(x=x, y=y, label=label),
                                         vjust=0.5, hjust=0.5, label.padding=unit(0.01, "lines"),
                                         label.size=NA, size=(base_size*0.352777778)*0.6
                                 )
-
-
-                #               gp = gp + annotation_custom(grob = rectGrob(x=0, y=0, gp=gpar(col="red"), just=c("left","bottom")), xmid, j[2], j[4], ymid)
-                #               gp = gp + annotation_custom(grob = rectGrob(x=0, y=0, gp=gpar(col="green"), just=c("left","bottom")), j[1], xmid, j[3], ymid)
-
-
                         }
 
                         gpGrob = ggplotGrob(gp);
@@ -1015,11 +2126,20 @@ if __name__ == "__main__":
                         unit(%(ann_height)s*%(args.gtf)s, "in")
                         )
 
+                # Note on read subsampling below the plot
+                caption = "%(caption)s"
+                captionGrob = NULL
+                if (nzchar(caption)) {
+                        captionGrob = textGrob(caption, gp=gpar(fontsize=base_size*0.6))
+                        height = height + 2*convertHeight(grobHeight(captionGrob), "in", valueOnly=TRUE)
+                }
+
                 # Arrange grobs
                 argrobs = arrangeGrob(
                         grobs=density_grobs,
                         ncol=1,
                         heights = heights,
+                        bottom = captionGrob
                 );
 
                 # Save plot to file in the requested format
@@ -1033,19 +2153,403 @@ if __name__ == "__main__":
                 dev.log = dev.off()
 
                 """ %({
-                        "out": "%s.%s" % (out_prefix, out_suffix),
+                        "out": output,
                         "out_format": args.out_format,
                         "out_resolution": args.out_resolution,
                         "args.gtf": float(bool(args.gtf)),
-                        "args.aggr": args.aggr.rstrip("_j"),
                         "signal_height": args.height,
                         "ann_height": args.ann_height,
                         "alpha": args.alpha,
-                        "fix_y_scale": ("TRUE" if args.fix_y_scale else "FALSE")
+                        "fix_y_scale": ("TRUE" if args.fix_y_scale else "FALSE"),
+                        "caption": caption,
+                        # All the digits, so that the highest arc apex is within limits
+                        "maxheight": repr(float(maxheights[0] if maxheights else 0)),
+                        "maxheight_j": repr(float(top)),
                         })
-                if os.getenv('GGSASHIMI_DEBUG') is not None:
+                data.close()
+                metrics.finish("script", script_start, OrderedDict([("output", output), ("script_size", len(R_script)), ("data_size", data.offset)]))
+                if debug:
                         with open("R_script", 'w') as r:
                                 r.write(R_script)
                 else:
-                        plot(R_script)
+                        plots.append((output, plot(R_script, pool, [data.path], metrics, output)))
+        return plots
+
+def default_options(**kwargs):
+        """Return the options of define_options with their default values,
+        updated with kwargs (named as the option destinations, e.g. bam, gtf,
+        overlay, shrink)"""
+        args = Namespace(**dict((action.dest, action.default) for action in define_options()._actions if action.dest != "help"))
+        for k, v in kwargs.items():
+                if not hasattr(args, k):
+                        raise TypeError("Unknown option '{}'".format(k))
+                setattr(args, k, v)
+        return args
+
+
+def check_options(args):
+        """Raise ValueError on incompatible options"""
+        if args.aggr and not args.overlay:
+                raise ValueError("Cannot apply aggregate function if overlay is not selected.")
+        if not 0 < args.sample_fraction <= 1:
+                raise ValueError("The sample fraction must be in (0, 1].")
+        if args.max_reads < 0:
+                raise ValueError("The maximum number of reads cannot be negative.")
+        if args.window_size < 0:
+                raise ValueError("The window size cannot be negative.")
+        if args.out_format not in ('pdf', 'png', 'svg', 'tiff', 'jpeg'):
+                raise ValueError("Provided output format '%s' is not available. Please select among 'pdf', 'png', 'svg', 'tiff' or 'jpeg'" % args.out_format)
+
+
+def read_samples(args):
+        """Return the samples listed in the bam option whose files exist, as
+        tuples (id, files, overlay level, color level, label)"""
+        samples = [sample for sample in read_bam_input(args.bam, args.overlay, args.color_factor, args.labels) if all(map(os.path.isfile, sample[1].split(",")))]
+
+        # Coverage tracks: one per strand plus the junction file
+        for sample in samples:
+                n_files = len(sample[1].split(","))
+                if n_files > 1 and n_files != (2 if args.strand == "NONE" else 3):
+                        raise ValueError("Sample {} needs one coverage track per strand and a junction file.".format(sample[0]))
+
+        # No bam files
+        if not samples:
+                raise ValueError("No available bam files.")
+        return samples
+
+
+# Data of a region ready to be plotted: signal and junctions of each sample per
+# strand (bam_dict, see prepare_for_R), plot groups and the annotation
+Tracks = namedtuple("Tracks", ["region", "bam_dict", "overlay_dict", "color_dict", "id_list", "label_dict", "junctions", "transcripts", "exons", "sample_fractions"])
+
+
+class Sashimi(object):
+        """Sashimi plots of a set of samples, to be used from Python. Options are
+        those of the command line, given as an argparse namespace or as keyword
+        arguments named as the option destinations. Samples, annotation, cache
+        and R workers are set up once, so many regions can be computed and
+        rendered within a long-lived process:
+
+                sashimi = Sashimi(bam="input_bams.tsv", gtf="annotation.gtf", overlay=3)
+                for tracks in sashimi.compute_tracks(["chr10:27040584-27048100"]):
+                        sashimi.render(tracks, "sashimi")
+                sashimi.close()
+        """
+
+        def __init__(self, args=None, **kwargs):
+                self.args = args if args is not None else default_options(**kwargs)
+                check_options(self.args)
+                self.palette = read_palette(self.args.palette)
+                self.samples = read_samples(self.args)
+                self.metrics = Metrics()
+                self.cache = CoverageCache(self.args.cache_dir, self.args.cache_size * 1024**2) if self.args.cache_dir else None
+                self.pool = None
+                # Annotation parsed so far, by chromosome, unless it is indexed
+                self.gtf_records = None
+                self.gtf_chrs = set()
+                self.lock = threading.Lock()
+                if self.args.gtf and not is_tabix_indexed(self.args.gtf):
+                        self.gtf_records = dict()
+
+        def load_annotation(self, chrs):
+                """Parse the annotation of the chromosomes not read yet, in one pass"""
+                with self.lock:
+                        chrs = set(chrs) - self.gtf_chrs
+                        if self.gtf_records is None or not chrs:
+                                return
+                        with self.metrics.timer("read_gtf", file=self.args.gtf):
+                                self.gtf_records.update(load_gtf(self.args.gtf, chrs))
+                        self.gtf_chrs |= chrs
+
+        def annotation(self, c):
+                """Return the transcripts and exons in region c"""
+                if self.gtf_records is not None:
+                        self.load_annotation([parse_coordinates(c)[0]])
+                        return select_gtf(self.gtf_records, c)
+                if self.args.gtf:
+                        with self.metrics.timer("read_gtf", file=self.args.gtf, region=c):
+                                return read_gtf(self.args.gtf, c)
+                return None, None
+
+        def select_samples(self, ids):
+                """Return the samples with the given ids, in the order of the bam option"""
+                unknown = set(ids) - set(sample[0] for sample in self.samples)
+                if unknown:
+                        raise ValueError("Unknown samples: {}".format(", ".join(sorted(unknown))))
+                return [sample for sample in self.samples if sample[0] in ids]
+
+        def screen_samples(self, samples, c):
+                """Return the samples with at least min_reads mapped reads in
+                region c, counted through the index. Counts are kept in the cache,
+                if any, so that cached regions are screened without opening the
+                bam files. Samples that cannot be screened (sam files and coverage
+                tracks) are kept."""
+                args = self.args
+                if args.min_reads <= 0:
+                        return samples
+                kept = []
+                with self.metrics.timer("screen", region=c) as info:
+                        for sample in samples:
+                                n = self.cache.get_count(sample[1], c, args.min_reads) if self.cache is not None else None
+                                if n is None:
+                                        n = count_reads(sample[1], c, args.min_reads, args.decompression_threads, args.reference)
+                                        if n is not None and self.cache is not None:
+                                                self.cache.put_count(sample[1], c, n, args.min_reads)
+                                if n is not None and n < args.min_reads:
+                                        if n == 0:
+                                                print("WARN: Sample {} has no reads in the specified area.".format(sample[0]))
+                                        else:
+                                                print("WARN: Sample {} has fewer than {} reads in the specified area.".format(sample[0], args.min_reads))
+                                        continue
+                                kept.append(sample)
+                        info["skipped"] = len(samples) - len(kept)
+                return kept
+
+        def compute_tracks(self, regions, samples=None):
+                """Yield the Tracks of each region (chr:start-end) in turn, for all
+                the samples or those with the ids in samples. Samples without
+                enough reads in a region are left out (see screen_samples). Samples
+                of the following regions are read ahead by the process pool."""
+                regions = list(regions)
+                samples = self.samples if samples is None else self.select_samples(samples)
+                self.load_annotation(parse_coordinates(c)[0] for c in regions)
+                args = self.args
+                region_samples = [self.screen_samples(samples, c) for c in regions]
+                tasks = [(sample[1], c) for c, kept in zip(regions, region_samples) for sample in kept]
+                coverages = read_bams(tasks, args.strand, args.threads, self.cache, args.decompression_threads, args.reference, self.metrics, args.sample_fraction, args.max_reads, args.window_size)
+                for c, kept in zip(regions, region_samples):
+                        bam_dict, overlay_dict, color_dict, id_list, label_dict, junctions, sample_fractions = collect_tracks(kept, islice(coverages, len(kept)), c, args)
+                        transcripts, exons = self.annotation(c)
+                        yield Tracks(c, bam_dict, overlay_dict, color_dict, id_list, label_dict, junctions, transcripts, exons, sample_fractions)
+
+        def render(self, tracks, out_prefix=None, out_suffix=None, wait=False, **options):
+                """Render the plots of a region (one per strand) to out_prefix
+                [default=out_prefix option] and return their file names, none if
+                no sample has reads in the region. Display
+                options (e.g. out_format, out_strand, width) can be overridden for
+                these plots. With the R engine, plots are rendered in the
+                background by persistent R workers, until close is called, unless
+                wait is set."""
+                args = self.args
+                if options:
+                        args = Namespace(**vars(self.args))
+                        for k, v in options.items():
+                                if not hasattr(args, k):
+                                        raise TypeError("Unknown option '{}'".format(k))
+                                setattr(args, k, v)
+                        check_options(args)
+                if out_suffix is None:
+                        out_prefix, out_suffix = get_out_prefix(out_prefix or args.out_prefix, args.out_format)
+                if not tracks.id_list:
+                        print("WARN: No sample has reads in region {}, nothing to plot.".format(tracks.region))
+                        return []
+                with self.lock:
+                        if self.pool is None and args.engine == "R":
+                                self.pool = RPool(args.render_workers)
+                plots = plot_region(tracks.bam_dict, tracks.overlay_dict, tracks.color_dict, tracks.id_list, tracks.label_dict,
+                        tracks.transcripts, tracks.exons, self.palette, out_prefix, out_suffix, args, self.pool, self.metrics, tracks.sample_fractions)
+                if wait:
+                        for _, future in plots:
+                                if future is not None:
+                                        future.result()
+                return [output for output, _ in plots]
+
+        def close(self):
+                """Wait for the pending plots and stop the R workers"""
+                if self.pool is not None:
+                        self.pool.close()
+                        self.pool = None
+                if self.cache is not None:
+                        self.cache.evict()
+                close_files()
+
+
+CONTENT_TYPES = {"pdf": "application/pdf", "png": "image/png", "svg": "image/svg+xml", "jpeg": "image/jpeg", "tiff": "image/tiff"}
+
+
+def make_server(sashimi, host="127.0.0.1", port=8000, workers=2, queue_size=16):
+        """Return an HTTP server answering GET /plot?region=chr:start-end with
+        the plot of the region, rendered by sashimi. Optional parameters are
+        samples (comma-separated ids), format and strand (plus or minus, needed
+        for stranded plots unless --out-strand is set). Requests are handled by
+        a pool of workers, each one with its own open bam files; at most
+        queue_size requests wait for a worker, and further ones are answered
+        with 503."""
+        try:
+                from http.server import HTTPServer, BaseHTTPRequestHandler
+                from urllib.parse import urlparse, parse_qs
+        except ImportError:
+                from BaseHTTPServer import HTTPServer, BaseHTTPRequestHandler
+                from urlparse import urlparse, parse_qs
+
+        class PlotRequestHandler(BaseHTTPRequestHandler):
+
+                def send_text(self, code, message):
+                        body = (message + "\n").encode("utf-8")
+                        self.send_response(code)
+                        self.send_header("Content-Type", "text/plain; charset=utf-8")
+                        self.send_header("Content-Length", str(len(body)))
+                        self.end_headers()
+                        self.wfile.write(body)
+
+                def do_GET(self):
+                        url = urlparse(self.path)
+                        if url.path != "/plot":
+                                self.send_text(404, "Not found: use /plot?region=chr:start-end")
+                                return
+                        query = dict((k, v[-1]) for k, v in parse_qs(url.query).items())
+                        if "region" not in query:
+                                self.send_text(400, "Missing region parameter")
+                                return
+                        options = dict(out_format=query.get("format", sashimi.args.out_format))
+                        if "strand" in query:
+                                options["out_strand"] = query["strand"]
+                        samples = query["samples"].split(",") if query.get("samples") else None
+                        out_dir = tempfile.mkdtemp(prefix="ggsashimi")
+                        try:
+                                if options["out_format"] not in CONTENT_TYPES or options.get("out_strand", "both") not in ("both", "plus", "minus"):
+                                        raise ValueError("Unknown format or strand")
+                                try:
+                                        parse_coordinates(query["region"])
+                                except (ValueError, IndexError):
+                                        raise ValueError("Invalid region '{}', the format is chr:start-end".format(query["region"]))
+                                tracks = next(sashimi.compute_tracks([query["region"]], samples))
+                                if not tracks.id_list:
+                                        raise ValueError("No reads in region {}".format(query["region"]))
+                                outputs = sashimi.render(tracks, os.path.join(out_dir, "sashimi"), options["out_format"], wait=True, **options)
+                                if len(outputs) != 1:
+                                        raise ValueError("Stranded plots need strand=plus or strand=minus")
+                                with open(outputs[0], "rb") as f:
+                                        body = f.read()
+                        except (ValueError, KeyError) as e:
+                                self.send_text(400, "ERROR: {}".format(e))
+                                return
+                        except (IOError, OSError) as e:
+                                self.send_text(500, "ERROR: plot could not be rendered ({})".format(e))
+                                return
+                        finally:
+                                shutil.rmtree(out_dir, ignore_errors=True)
+                        self.send_response(200)
+                        self.send_header("Content-Type", CONTENT_TYPES[options["out_format"]])
+                        self.send_header("Content-Length", str(len(body)))
+                        self.end_headers()
+                        self.wfile.write(body)
+
+        class PlotServer(HTTPServer):
+
+                def __init__(self):
+                        HTTPServer.__init__(self, (host, port), PlotRequestHandler)
+                        self.executor = ThreadPoolExecutor(max_workers=workers)
+                        # Requests being processed or waiting for a worker
+                        self.slots = threading.BoundedSemaphore(workers + queue_size)
+
+                def process_request(self, request, client_address):
+                        if not self.slots.acquire(False):
+                                request.sendall(b"HTTP/1.0 503 Service Unavailable\r\nRetry-After: 1\r\nContent-Length: 0\r\n\r\n")
+                                self.shutdown_request(request)
+                                return
+                        self.executor.submit(self.process_request_worker, request, client_address)
+
+                def process_request_worker(self, request, client_address):
+                        try:
+                                self.finish_request(request, client_address)
+                        except Exception:
+                                self.handle_error(request, client_address)
+                        finally:
+                                self.shutdown_request(request)
+                                self.slots.release()
+
+                def server_close(self):
+                        HTTPServer.server_close(self)
+                        self.executor.shutdown(wait=True)
+
+        return PlotServer()
+
+
+def serve(argv):
+        """Serve plots over HTTP until interrupted (see make_server). Samples,
+        annotation, open files and renderers are kept between requests."""
+        args = define_options(serve=True).parse_args(argv)
+        try:
+                sashimi = Sashimi(args)
+        except ValueError as e:
+                print("ERROR: {}".format(e))
+                exit(1)
+        # Keep the metrics of the latest plots only
+        sashimi.metrics = Metrics(max_stages=10000)
+        server = make_server(sashimi, args.host, args.port, args.workers, args.queue_size)
+        print("Serving sashimi plots on http://{}:{}/plot".format(*server.server_address[:2]))
+        try:
+                server.serve_forever()
+        except KeyboardInterrupt:
+                pass
+        finally:
+                server.server_close()
+                sashimi.close()
+                if args.metrics_json:
+                        sashimi.metrics.write(args.metrics_json)
+
+
+def main(argv=None):
+
+        parser = define_options()
+        argv = sys.argv[1:] if argv is None else argv
+        if not argv:
+            parser.print_help()
+            sys.exit(1)
+        if argv[0] == "serve":
+                serve(argv[1:])
+                return
+        args = parser.parse_args(argv)
+
+#       args.coordinates = "chrX:9609491-9612406"
+#       args.coordinates = "chrX:9609491-9610000"
+#       args.bam = "/nfs/no_backup/rg/epalumbo/projects/tg/work/8b/8b0ac8705f37fd772a06ab7db89f6b/2A_m4_n10_toGenome.bam"
+
+        if args.profile:
+                import cProfile
+                profiler = cProfile.Profile()
+                profiler.enable()
+
+        try:
+                sashimi = Sashimi(args)
+        except ValueError as e:
+                print("ERROR: {}".format(e))
+                exit(1)
+
+        # Single region or batch of regions from a BED file
+        if args.regions:
+                regions = list(read_regions(args.regions))
+        else:
+                regions = [(None, args.coordinates)]
+
+        out_prefix, out_suffix = get_out_prefix(args.out_prefix, args.out_format)
+
+        junctions_list = []
+
+        for (name, c), tracks in zip(regions, sashimi.compute_tracks(c for _, c in regions)):
+                junctions_list += tracks.junctions
+                region_prefix = out_prefix if name is None else "%s_%s" %(out_prefix, name)
+                sashimi.render(tracks, region_prefix, out_suffix)
+
+        sashimi.close()
+
+        # Write junctions to BED
+        if args.junctions_bed:
+                if not args.junctions_bed.endswith('.bed'):
+                        args.junctions_bed = args.junctions_bed + '.bed'
+                jbed = open(args.junctions_bed, 'w')
+                jbed.write('\n'.join(sorted(junctions_list)))
+                jbed.close()
+
+        if args.metrics_json:
+                sashimi.metrics.write(args.metrics_json)
+
+        if args.profile:
+                profiler.disable()
+                profiler.dump_stats("%s.prof" % out_prefix)
+
+
+if __name__ == "__main__":
+        main()
         exit()
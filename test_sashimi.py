@@ -1,6 +1,11 @@
 #!/usr/bin/env python
+import os
 import re
-import importlib 
+import sys
+import subprocess
+import threading
+import importlib
+import pytest
 from collections import OrderedDict
 
 sp = importlib.import_module('ggsashimi')
@@ -102,3 +107,528 @@ def test_intersect_introns():
     i = list(sp.intersect_introns(data))
     assert len(i) == 2
     assert i == [(27040713, 27044584), (27044671, 27047991)]
+    assert list(sp.intersect_introns([])) == []
+
+def test_read_bam():
+    bam = 'examples/bams/ENCFF088HTJ.chr10_27035000_27050000.bam'
+    c = 'chr10:27040584-27048100'
+    chr, start, end = sp.parse_coordinates(c)
+
+    # Reference implementation parsing CIGAR strings with count_operator
+    ref_a, ref_j = {}, {}
+    for strand in ('+', '-'):
+        ref_a[strand] = [0] * (end - start)
+        ref_j[strand] = OrderedDict()
+    samfile = sp.pysam.AlignmentFile(bam)
+    for read in samfile.fetch(chr, start, end):
+        CIGAR = read.cigarstring
+        if any(x in CIGAR for x in ["H", "P", "X", "="]):
+            continue
+        strand = ['+', '-'][read.is_reverse]
+        pos = read.reference_start + 1
+        lens = re.split("[MIDNS]", CIGAR)[:-1]
+        ops = re.split("[0-9]+", CIGAR)[1:]
+        for n, op in enumerate(ops):
+            pos = sp.count_operator(op, int(lens[n]), pos, start, end, ref_a[strand], ref_j[strand])
+    samfile.close()
+
+    a, j, _ = sp.read_bam(bam, c, 'SENSE')
+    assert dict((k, list(v)) for k, v in a.items()) == ref_a
+    assert j == ref_j
+    assert list(j['+'].items()) == list(ref_j['+'].items())
+
+def test_read_alignment_formats(tmp_path):
+    # Small synthetic bam, converted to cram and sam
+    rnd = sp.np.random.RandomState(1)
+    fasta = str(tmp_path / "ref.fa")
+    with open(fasta, "w") as out:
+        out.write(">chrT\n" + "".join(rnd.choice(list("ACGT"), 1000)) + "\n")
+    sp.pysam.faidx(fasta)
+    bam = str(tmp_path / "reads.bam")
+    header = {'HD': {'VN': '1.0', 'SO': 'coordinate'}, 'SQ': [{'LN': 1000, 'SN': 'chrT'}]}
+    with sp.pysam.AlignmentFile(bam, "wb", header=header) as out:
+        for i, pos in enumerate(sorted(rnd.randint(0, 800, 40))):
+            read = sp.pysam.AlignedSegment()
+            read.query_name = "r%d" % i
+            read.reference_id = 0
+            read.reference_start = int(pos)
+            read.flag = 16 if i % 3 else 0
+            read.cigarstring = "20M100N30M" if i % 2 and pos < 700 else "50M"
+            read.query_sequence = "A" * 50
+            read.mapping_quality = 60
+            out.write(read)
+    sp.pysam.index(bam)
+    cram, sam = str(tmp_path / "reads.cram"), str(tmp_path / "reads.sam")
+    sp.pysam.view("-C", "-T", fasta, "-o", cram, bam, catch_stdout=False)
+    sp.pysam.index(cram)
+    sp.pysam.view("-h", "-o", sam, bam, catch_stdout=False)
+
+    c = 'chrT:101-900'
+    a, j, _ = sp.read_bam(bam, c, 'SENSE')
+    assert sum(map(len, j.values())) > 0
+    for f in (cram, sam):
+        a2, j2, _ = sp.read_bam(f, c, 'SENSE', 2, fasta)
+        assert all(list(a[s]) == list(a2[s]) for s in a) and j == j2
+    # The sam file is scanned again for another region
+    assert list(sp.read_bam(sam, 'chrT:1-500', 'NONE')[0]['+']) == list(sp.read_bam(bam, 'chrT:1-500', 'NONE')[0]['+'])
+
+    assert list(sp.read_bam_input(cram, None, None, None)) == [("reads", cram, None, None, "reads")]
+
+def test_many_samples(tmp_path):
+    # Many samples (links to the same bam) are read with few file descriptors
+    bam = os.path.abspath('examples/bams/ENCFF088HTJ.chr10_27035000_27050000.bam')
+    with open(str(tmp_path / 'bams.tsv'), 'w') as out:
+        for i in range(180):
+            link = str(tmp_path / ('s%d.bam' % i))
+            os.symlink(bam, link)
+            os.symlink(bam + '.bai', link + '.bai')
+            out.write('s%d\t%s\n' % (i, link))
+    script = (
+        "import resource, ggsashimi as sp\n"
+        "resource.setrlimit(resource.RLIMIT_NOFILE, (64, resource.getrlimit(resource.RLIMIT_NOFILE)[1]))\n"
+        "sashimi = sp.Sashimi(bam=%r)\n"
+        "tracks = list(sashimi.compute_tracks(['chr10:27040584-27048100']))\n"
+        "assert len(tracks[0].id_list) == 180\n"
+        "assert sp.open_files_limit() == 32\n"
+        "assert max(map(len, sp.open_files.values())) <= sp.open_files_limit()\n"
+        "sashimi.close()\n"
+        "assert not any(sp.open_files.values())\n" % str(tmp_path / 'bams.tsv'))
+    subprocess.check_call([sys.executable, '-c', script], cwd=os.path.dirname(os.path.abspath(sp.__file__)))
+
+def test_open_files_reused(tmp_path, monkeypatch):
+    # Each bam is opened once, from the screen of the first region to the
+    # read of the last one
+    bam = os.path.abspath('examples/bams/ENCFF088HTJ.chr10_27035000_27050000.bam')
+    with open(str(tmp_path / 'bams.tsv'), 'w') as out:
+        for i in range(40):
+            link = str(tmp_path / ('s%d.bam' % i))
+            os.symlink(bam, link)
+            os.symlink(bam + '.bai', link + '.bai')
+            out.write('s%d\t%s\n' % (i, link))
+    opened = []
+    AlignmentFile = sp.pysam.AlignmentFile
+    def opener(f, **kwargs):
+        opened.append(f)
+        return AlignmentFile(f, **kwargs)
+    monkeypatch.setattr(sp.pysam, 'AlignmentFile', opener)
+    sashimi = sp.Sashimi(bam=str(tmp_path / 'bams.tsv'))
+    regions = ['chr10:27040584-27048100', 'chr10:27041000-27043000', 'chr10:27045000-27047000']
+    tracks = list(sashimi.compute_tracks(regions))
+    sashimi.close()
+    assert [len(t.id_list) for t in tracks] == [40, 40, 40]
+    assert len(opened) == 40
+
+def test_metrics(tmp_path):
+    bam = 'examples/bams/ENCFF088HTJ.chr10_27035000_27050000.bam'
+    metrics = sp.Metrics()
+    list(sp.read_bams([(bam, 'chr10:27040584-27048100')], 'NONE', metrics=metrics))
+    with metrics.timer("render", output="out.pdf") as info:
+        info["script_size"] = 10
+    f = str(tmp_path / "metrics.json")
+    metrics.write(f)
+    stages = sp.json.load(open(f))["stages"]
+    assert [stage["stage"] for stage in stages] == ["read_bam", "render"]
+    assert stages[0]["reads"] > 0 and stages[0]["skipped"] == 0 and not stages[0]["cached"]
+    assert stages[1]["output"] == "out.pdf" and stages[1]["script_size"] == 10 and stages[1]["time"] >= 0
+
+    # Peak memory is that of each stage, not of the process so far
+    if sp.proc_status_mb("VmRSS") is not None:
+        max_rss = sp.max_rss()
+        metrics = sp.Metrics()
+        with metrics.timer("large"):
+            a = sp.np.ones(25 * 1024**2)
+            sp.time.sleep(0.1)
+            del a
+        with metrics.timer("small"):
+            pass
+        large, small = metrics.stages
+        assert large["peak_rss_increase"] > 150 and small["peak_rss_increase"] < 50
+        assert small["peak_rss"] < large["peak_rss"]
+        # The high-water mark of the process is left alone
+        assert sp.max_rss() >= max_rss
+
+def test_sashimi_api():
+    sashimi = sp.Sashimi(bam='examples/input_bams.tsv', gtf='examples/annotation.gtf', overlay=3, strand='SENSE')
+    assert sashimi.args.height == sp.default_options().height
+    c = 'chr10:27040584-27048100'
+    tracks = list(sashimi.compute_tracks([c, c]))
+    assert [t.region for t in tracks] == [c, c]
+    assert len(tracks[0].id_list) == 12 and list(tracks[0].overlay_dict) == ['Endothelial', 'Epithelial', 'Mesenchymal']
+    start, y = tracks[0].bam_dict['-']['ENCLB024ZZZ'][:2]
+    a, _, _ = sp.read_bam('examples/bams/ENCFF088HTJ.chr10_27035000_27050000.bam', c, 'SENSE')
+    assert start == sp.parse_coordinates(c)[1] and list(y) == list(a['-'])
+    assert tracks[0].transcripts == tracks[1].transcripts and tracks[0].transcripts
+    sashimi.close()
+
+    with pytest.raises(ValueError):
+        sp.Sashimi(bam='examples/input_bams.tsv', aggr='mean')
+    with pytest.raises(TypeError):
+        sp.Sashimi(bam='examples/input_bams.tsv', colour=3)
+
+def test_read_bam_subsampling():
+    bam = 'examples/bams/ENCFF088HTJ.chr10_27035000_27050000.bam'
+    c = 'chr10:27040584-27048100'
+    stats = {}
+    a, j, fraction = sp.read_bam(bam, c, 'NONE', stats=stats)
+    n = stats['reads']
+
+    stats = {}
+    a2, j2, fraction2 = sp.read_bam(bam, c, 'NONE', stats=stats, sample_fraction=0.25)
+    assert fraction == 1 and fraction2 == stats['sample_fraction'] == 0.25 and 0.2 * n < stats['reads'] < 0.3 * n
+    # Counts are scaled back up, and the same reads are selected each time
+    assert 0.9 < a2['+'].sum() / float(a['+'].sum()) < 1.1
+    assert set(j2['+']) <= set(j['+']) and all(v % 4 == 0 for v in j2['+'].values())
+    a3, j3, _ = sp.read_bam(bam, c, 'NONE', sample_fraction=0.25)
+    assert list(a3['+']) == list(a2['+']) and j3 == j2
+
+    stats = {}
+    fraction = sp.read_bam(bam, c, 'NONE', stats=stats, max_reads=n // 2)[2]
+    assert stats['reads'] <= 0.6 * n and stats['sample_fraction'] == fraction == float(n // 2) / n
+    stats = {}
+    fraction = sp.read_bam(bam, c, 'NONE', stats=stats, max_reads=n)[2]
+    assert stats['reads'] == n and 'sample_fraction' not in stats and fraction == 1
+
+    # The plots note subsampling only if some sample was subsampled
+    sashimi = sp.Sashimi(bam='examples/input_bams.tsv', max_reads=10**6)
+    tracks, = sashimi.compute_tracks([c])
+    assert set(tracks.sample_fractions.values()) == {1}
+    assert sp.sampling_caption(1, 10**6, tracks.sample_fractions.values()) == ''
+    assert sp.sampling_caption(1, 100, [1, 0.5]) == 'Coverage and junction counts estimated from at most 100 reads per sample'
+    assert sp.sampling_caption(0.5, 100, [0.5, 0.5]) == 'Coverage and junction counts estimated from 50% of the reads'
+    sashimi.close()
+
+    with pytest.raises(ValueError):
+        sp.Sashimi(bam='examples/input_bams.tsv', sample_fraction=0)
+
+def test_read_bam_windows(tmp_path):
+    bam = 'examples/bams/ENCFF088HTJ.chr10_27035000_27050000.bam'
+    c = 'chr10:27040584-27048100'
+    # Reads and junctions spanning windows are counted once (1 bp windows on
+    # a short region around an exon, to keep the test fast)
+    for region, window_size in (('chr10:27044500-27044800', 1), (c, 100), (c, 1000), (c, 10**6)):
+        stats, stats_w = {}, {}
+        a, j, _ = sp.read_bam(bam, region, 'SENSE', stats=stats)
+        a_w, j_w, _ = sp.read_bam(bam, region, 'SENSE', stats=stats_w, window_size=window_size)
+        assert stats_w == stats and j_w == j and j
+        assert all(isinstance(a_w[k], sp.RunLengthCoverage) for k in a_w)
+        assert all(len(a_w[k]) == len(a[k]) and list(sp.np.asarray(a_w[k])) == list(a[k]) for k in a)
+    a_w, j_w, fraction = sp.read_bam(bam, c, 'SENSE', window_size=500, sample_fraction=0.25)
+    assert list(sp.np.asarray(a_w['+'])) == list(sp.read_bam(bam, c, 'SENSE', sample_fraction=0.25)[0]['+'])
+
+    runs = sp.RunLengthCoverage.from_array(sp.np.array([0, 0, 3, 3, 1], dtype=sp.np.uint32))
+    assert list(runs.ends) == [2, 4, 5] and list(runs.values) == [0, 3, 1]
+    assert runs[2] == 3 and runs[-1] == 1 and runs.any()
+
+    # Runs are kept as such in the cache
+    cache = sp.CoverageCache(str(tmp_path / 'cache'), 1024**2)
+    cache.put(bam, c, 'SENSE', (a_w, j_w, fraction))
+    cached_a, _, cached_fraction = cache.get(bam, c, 'SENSE')
+    assert cached_fraction == fraction == 0.25
+    assert isinstance(cached_a['+'], sp.RunLengthCoverage)
+    assert list(sp.np.asarray(cached_a['+'])) == list(sp.np.asarray(a_w['+']))
+
+def test_screen_samples():
+    bam = 'examples/bams/ENCFF088HTJ.chr10_27035000_27050000.bam'
+    c = 'chr10:27040584-27048100'
+    assert sp.count_reads(bam, c, 5) == 5 and sp.count_reads(bam, 'chr10:1000-2000', 5) == 0
+    assert sp.count_reads(bam + ',junctions.bed', c, 5) is None
+
+    sashimi = sp.Sashimi(bam='examples/input_bams.tsv', min_reads=10**9)
+    assert sashimi.screen_samples(sashimi.samples, c) == []
+    tracks = next(sashimi.compute_tracks([c]))
+    assert tracks.id_list == [] and sashimi.render(tracks) == []
+    # Empty samples are left out after reading too
+    sashimi = sp.Sashimi(bam='examples/input_bams.tsv', min_reads=0, strand='SENSE')
+    assert next(sashimi.compute_tracks(['chr10:1000-2000'])).id_list == []
+    assert len(next(sashimi.compute_tracks([c])).id_list) == 12
+    sashimi.close()
+
+def test_cached_screen(tmp_path, monkeypatch):
+    c = 'chr10:27040584-27048100'
+    sashimi = sp.Sashimi(bam='examples/input_bams.tsv', cache_dir=str(tmp_path / 'cache'), min_reads=2500)
+    id_list = next(sashimi.compute_tracks([c])).id_list
+    assert 0 < len(id_list) < 12
+    sashimi.close()
+
+    # Samples in the cache are screened without opening their bam files
+    sp.close_files()
+    def fail(*args, **kwargs):
+        raise AssertionError("bam file opened")
+    monkeypatch.setattr(sp.pysam, 'AlignmentFile', fail)
+    sashimi = sp.Sashimi(bam='examples/input_bams.tsv', cache_dir=str(tmp_path / 'cache'), min_reads=2500)
+    assert next(sashimi.compute_tracks([c])).id_list == id_list
+    sashimi.close()
+
+def test_read_regions(tmp_path):
+    bed = tmp_path / 'regions.bed'
+    bed.write_text(u'track name=events\nchr10\t27040583\t27048100\tevent1\nchr10\t1000\t2000\n')
+    regions = list(sp.read_regions(str(bed)))
+    assert regions == [('event1', 'chr10:27040584-27048100'), ('chr10_1000_2000', 'chr10:1001-2000')]
+    assert sp.parse_coordinates(regions[0][1]) == ('chr10', 27040583, 27048100)
+
+def test_rdata(tmp_path):
+    data = sp.RData(str(tmp_path / 'data.bin'))
+    exprs = [data.column([1, 2, 3]), data.column([0.5, 2.25]), data.column([])]
+    data.close()
+    assert exprs == ['read_column("integer", 0, 3)', 'read_column("double", 12, 2)', 'read_column("double", 28, 0)']
+    raw = (tmp_path / 'data.bin').read_bytes()
+    assert list(sp.np.frombuffer(raw, dtype='<i4', count=3)) == [1, 2, 3]
+    assert list(sp.np.frombuffer(raw, dtype='<f8', count=2, offset=12)) == [0.5, 2.25]
+
+def test_bin_density():
+    x, y = [10, 11, 12, 13, 14, 20, 21], [1, 5, 2, 0, 3, 7, 1]
+    assert [a.tolist() for a in sp.bin_density(x, y, 1)] == [x, y]
+    assert [a.tolist() for a in sp.bin_density(x, y, 3)] == [[11, 14, 20], [5, 3, 7]]
+    assert [a.tolist() for a in sp.bin_density(x, y, 2)] == [[10.5, 12.5, 14.5, 20.5], [5, 2, 3, 7]]
+
+    x, y = sp.density_xy(10, sp.np.array([1, 5, 2, 0], dtype=sp.np.uint32), None, 2)
+    assert x.tolist() == [10.5, 12.5] and y.tolist() == [5, 2]
+
+def test_rle_density():
+    # Runs break on value changes and on gaps between bins
+    x, y = [10, 11, 12, 13, 20, 21, 5, 6], [0, 0, 3, 3, 3, 3, 1, 1]
+    xmin, xmax, v = sp.rle_density(x, y, 1)
+    assert xmin.tolist() == [9.5, 11.5, 19.5, 4.5]
+    assert xmax.tolist() == [11.5, 13.5, 21.5, 6.5]
+    assert v.tolist() == [0, 3, 3, 1]
+
+    x, y = sp.bin_density(list(range(100, 110)), [1, 1, 1, 1, 2, 2, 2, 0, 0, 0], 2)
+    xmin, xmax, v = sp.rle_density(x, y, 2)
+    assert list(zip(xmin, xmax, v)) == [(99.5, 103.5, 1), (103.5, 107.5, 2), (107.5, 109.5, 0)]
+
+def test_aggregate_density():
+    tracks = [[1, 4, 0], [3, 2, 0], [8, 0, 3]]
+    assert list(sp.aggregate_density(tracks, "mean")) == [4, 2, 1]
+    assert list(sp.aggregate_density(tracks, "median")) == [3, 2, 0]
+    assert list(sp.aggregate_density(tracks[:2], "median")) == [2, 3, 0]
+
+def test_junction_arcs():
+    dons, accs = [100, 100, 100, 300], [200, 200, 200, 400]
+    rows = sp.junction_rows(dons, accs, [10, 30, 20, 5], [40, 20, 30, 5], [3, 5, 4, 2])
+    assert rows[0] == (100, 200, 30, 40, 3, '3,5,4') and len(rows) == 4
+    assert sp.junction_rows(dons, accs, [10, 30, 20, 5], [40, 20, 30, 5], [3, 5, 4, 2], 'mean') == [(100, 200, 30, 40, 4, '4'), (300, 400, 5, 5, 2, '2')]
+
+    arcs = sp.junction_arcs(rows, 50)
+    assert [a[8] for a in arcs] == [True, False, True, False]
+    assert 40 * 1.2 <= arcs[0][5] <= 40 * 1.5 and -50 * 0.4 <= arcs[1][5] <= -50 * 0.2
+    assert arcs[0][4] == 150 and abs(sum(a[6] for a in arcs) - (3.9 + 4 * 0.1)) < 1e-9
+    assert sp.junction_arcs(rows, 50) == arcs
+
+    # Arcs from the donor up to the apex and back down to the acceptor; bottom arcs start at 0
+    arc, x, y = sp.arc_paths(arcs[:2], n=3)
+    assert list(arc) == [0] * 6 + [1] * 6
+    assert list(x[:6]) == [100, 112.5, 150, 150, 187.5, 200] and list(y[[0, 2, 5]]) == [30, arcs[0][5], 40]
+    assert list(y[[6, 8, 11]]) == [0, arcs[1][5], 0]
+    # The apex is exact, as the highest one sets the y limit with --fix-y-scale
+    arc, x, y = sp.arc_paths([(10, 37, 44.19006112954338, 44.19006112954338, 23.5, 745.7242066787065, 1, '1', True)])
+    assert y.max() == 745.7242066787065
+    tracks = [('a', sp.np.array([0.5]), sp.np.array([500.5]), sp.np.array([50.]), dons, accs, [10, 30, 20, 5], [40, 20, 30, 5], [3, 5, 4, 2])]
+    arcs_a, maxheights, top = sp.plot_junctions(tracks, 'mean_j', False, 100, 1)
+    assert maxheights == [50] and [a[2:4] for a in arcs_a[0]] == [(50, 50), (50, 50)] and top == arcs_a[0][0][5]
+
+    assert list(sp.extended_breaks(0, 623, 4)) == [0, 200, 400, 600]
+    assert list(sp.extended_breaks(0, 1, 4)) == [0, 0.5, 1]
+
+    xmin, xmax, y = sp.rle_density(sp.np.arange(100, 110), sp.np.array([0, 0, 3, 3, 3, 0, 0, 0, 7, 7]), 1)
+    assert sp.density_at(xmin, xmax, y, 103, 100, 1) == 3 and sp.density_at(xmin, xmax, y, 109, 100, 1) == 7
+    assert sp.density_at(xmin, xmax, y, 120, 100, 1) == 0
+
+def test_render_matplotlib(tmp_path):
+    matplotlib = pytest.importorskip('matplotlib')
+    # The backend of the calling process is left alone
+    backend = matplotlib.get_backend()
+    matplotlib.use('svg')
+    sashimi = sp.Sashimi(bam='examples/input_bams.tsv', gtf='examples/annotation.gtf', overlay=3, color_factor=3,
+        aggr='mean', shrink=True, engine='matplotlib', out_format='png', out_resolution=50)
+    for tracks in sashimi.compute_tracks(['chr10:27040584-27048100']):
+        sashimi.render(tracks, str(tmp_path / 'sashimi'))
+    sashimi.close()
+    assert matplotlib.get_backend() == 'svg'
+    matplotlib.use(backend)
+    assert sashimi.pool is None
+    with open(str(tmp_path / 'sashimi.png'), 'rb') as f:
+        assert f.read(8) == b'\x89PNG\r\n\x1a\n'
+
+def test_r_worker(tmp_path, monkeypatch, capsys):
+    # Stand-in for R: prints each script as is, then the end of script marker
+    # the way the worker loop does, and hangs on a script that says so
+    fake_R = tmp_path / 'R'
+    fake_R.write_text(u'#!%s\n' % sys.executable + u'\n'.join([
+        'import sys, time',
+        'for f in iter(sys.stdin.readline, "\\n"):',
+        '    script = open(f.strip()).read()',
+        '    if script == "hang":',
+        '        time.sleep(60)',
+        '    sys.stdout.write(script + "\\n%s\\n")' % sp.R_WORKER_DONE,
+        '    sys.stdout.flush()',
+    ]) + u'\n')
+    fake_R.chmod(0o755)
+    monkeypatch.setenv('PATH', str(tmp_path) + os.pathsep + os.environ['PATH'])
+    monkeypatch.setattr(sp, 'R_WORKER_TIMEOUT', 1)
+
+    # Output without a trailing newline does not hide the marker
+    worker = sp.RWorker()
+    worker.run('no newline')
+    worker.run('newline\n')
+    assert capsys.readouterr().out == 'no newline\nnewline\n'
+    # A worker without output is killed
+    with pytest.raises(RuntimeError):
+        worker.run('hang')
+    assert not worker.is_alive()
+    worker.close()
+
+    # and the pool starts a new one for the next script
+    pool = sp.RPool(1)
+    pool.submit('hang').result()
+    pool.submit('done').result()
+    pool.close()
+    out = capsys.readouterr().out
+    assert out.startswith('ERROR: R rendering failed') and out.endswith('done\n')
+    assert len(pool.workers) == 2
+
+def test_serve():
+    pytest.importorskip('matplotlib')
+    urllib = pytest.importorskip('urllib.request')
+    sashimi = sp.Sashimi(bam='examples/input_bams.tsv', overlay=3, engine='matplotlib', out_resolution=50)
+    server = sp.make_server(sashimi, port=0, workers=2, queue_size=1)
+    thread = threading.Thread(target=server.serve_forever)
+    thread.start()
+    url = 'http://127.0.0.1:%d/plot?' % server.server_address[1]
+    try:
+        response = urllib.urlopen(url + 'region=chr10:27040584-27048100&samples=ENCLB024ZZZ,ENCLB555AXD&format=png')
+        assert response.headers['Content-Type'] == 'image/png' and response.read(4) == b'\x89PNG'
+        for query in ('region=chr10:1-x', 'region=chr10:27040584-27048100&samples=unknown', 'format=png'):
+            with pytest.raises(urllib.HTTPError) as e:
+                urllib.urlopen(url + query)
+            assert e.value.code == 400
+    finally:
+        server.shutdown()
+        server.server_close()
+        thread.join()
+        sashimi.close()
+
+def test_read_gtf_indexed(tmp_path):
+    gtf = tmp_path / 'annotation.gtf'
+    gtf.write_text(open('examples/annotation.gtf').read())
+    indexed = sp.index_gtf(str(gtf))
+    assert indexed == str(tmp_path / 'annotation.sorted.gtf.gz')
+    assert sp.is_tabix_indexed(indexed)
+    assert not sp.is_tabix_indexed(str(gtf))
+    for c in ['chr10:27040584-27048100', 'chr1:1-100']:
+        transcripts, exons = sp.read_gtf(str(gtf), c)
+        idx_transcripts, idx_exons = sp.read_gtf(indexed, c)
+        assert dict(idx_transcripts) == dict(transcripts)
+        assert dict((k, sorted(v)) for k, v in idx_exons.items()) == dict((k, sorted(v)) for k, v in exons.items())
+
+    # Compressed input, in any order
+    lines = open('examples/annotation.gtf').readlines()
+    with sp.gzip.open(str(tmp_path / 'shuffled.gtf.gz'), 'wt') as out:
+        out.writelines(['#comment\n'] + lines[::-1])
+    with sp.gzip.open(sp.index_gtf(str(tmp_path / 'shuffled.gtf.gz')), 'rt') as sorted_gtf:
+        starts = [(line.split('\t')[0], int(line.split('\t')[3])) for line in sorted_gtf]
+    assert len(starts) == len(lines) and starts == sorted(starts)
+
+def test_coverage_cache(tmp_path, monkeypatch):
+    bam = 'examples/bams/ENCFF088HTJ.chr10_27035000_27050000.bam'
+    c = 'chr10:27040584-27048100'
+    cache = sp.CoverageCache(str(tmp_path / 'cache'), 1024**2)
+    a, j, _ = list(sp.read_bams([(bam, c)], 'SENSE', cache=cache))[0]
+
+    # Cached results are returned without reading the bam file
+    monkeypatch.setattr(sp, 'read_bam', None)
+    cached_a, cached_j, _ = list(sp.read_bams([(bam, c)], 'SENSE', cache=cache))[0]
+    assert sorted(cached_a) == ['+', '-']
+    assert all(list(cached_a[k]) == list(a[k]) for k in a)
+    assert list(cached_j['+'].items()) == list(j['+'].items())
+    assert list(cached_j['-'].items()) == list(j['-'].items())
+    assert cache.get(bam, c, 'NONE') is None
+
+    # Least recently used entries are evicted beyond the maximum size
+    cache.max_size = 0
+    cache.evict()
+    assert cache.get(bam, c, 'SENSE') is None
+
+    # Writes evict as soon as the cache is full, as in long-running servers
+    path = tmp_path / 'small'
+    cache = sp.CoverageCache(str(path), 1024**2)
+    cache.put(bam, c, 'SENSE', (a, j, 1.))
+    cache.max_size = 1.5 * sum(f.stat().st_size for f in path.iterdir())
+    for region in ('chr10:27040584-27044000', 'chr10:27044000-27048100', c):
+        cache.put(bam, region, 'SENSE', (a, j, 1.))
+        assert sum(f.stat().st_size for f in path.iterdir()) <= cache.max_size
+    assert cache.get(bam, c, 'SENSE') is not None
+
+def test_read_sample_tracks(tmp_path):
+    bam = 'examples/bams/ENCFF088HTJ.chr10_27035000_27050000.bam'
+    c = 'chr10:27040584-27048100'
+    chr, start, end = sp.parse_coordinates(c)
+    a, j, _ = sp.read_bam(bam, c, 'SENSE')
+
+    # Write coverage as bedGraph (one line per base) and junctions as SJ.out.tab
+    tracks = []
+    for strand in ('+', '-'):
+        track = tmp_path / ('coverage%s.bedGraph' % strand)
+        track.write_text(u''.join(u'%s\t%d\t%d\t%d\n' % (chr, start + i - 1, start + i, v) for i, v in enumerate(a[strand]) if v))
+        tracks.append(str(track))
+    sj = tmp_path / 'SJ.out.tab'
+    sj.write_text(u''.join(u'%s\t%d\t%d\t%d\t1\t1\t%d\t0\t30\n' % (chr, don, acc - 1, 1 if strand == '+' else 2, n)
+        for strand in ('+', '-') for (don, acc), n in j[strand].items()))
+
+    track_a, track_j, fraction = sp.read_sample(','.join(tracks + [str(sj)]), c, 'SENSE')
+    assert fraction == 1
+    assert all(list(track_a[k]) == list(a[k]) for k in a)
+    assert dict(track_j['+']) == dict(j['+'])
+    assert dict(track_j['-']) == dict(j['-'])
+
+    # Unstranded
+    track_a, track_j, _ = sp.read_sample(','.join([tracks[0], str(sj)]), c, 'NONE')
+    assert list(track_a['+']) == list(a['+'])
+    assert sum(track_j['+'].values()) == sum(j['+'].values()) + sum(j['-'].values())
+
+def test_read_coverage_bigwig(tmp_path):
+    pyBigWig = pytest.importorskip('pyBigWig')
+    bam = 'examples/bams/ENCFF088HTJ.chr10_27035000_27050000.bam'
+    c = 'chr10:27040584-27048100'
+    chr, start, end = sp.parse_coordinates(c)
+    a, _, _ = sp.read_bam(bam, c, 'NONE')
+
+    bw = pyBigWig.open(str(tmp_path / 'coverage.bw'), 'w')
+    bw.addHeader([(chr, 135534747)])
+    bw.addEntries(chr, start - 1, values=[float(v) for v in a['+']], span=1, step=1)
+    bw.close()
+    assert list(sp.read_coverage_track(str(tmp_path / 'coverage.bw'), c)) == list(a['+'])
+
+def test_shrink_coordinates():
+    introns = [(100, 200), (300, 1300)]
+    smap = sp.shrink_map(introns)
+    # 100 bp shrunk to 25 bp, 1000 bp to 125 bp
+    assert list(smap[2]) == [0, 75, 950]
+    p, inside = sp.shrink_coordinates([50, 100, 150, 200, 250, 300, 800, 1300, 1400], smap)
+    assert list(p) == [50, 100, 112, 125, 175, 225, 287, 350, 450]
+    assert list(inside) == [False, False, True, False, False, False, True, False, False]
+
+    x = sp.np.arange(90, 1310)
+    new_x, new_y = sp.shrink_density(90, x, smap)
+    new_x, new_y = new_x.tolist(), new_y.tolist()
+    assert new_y == list(range(90, 101)) + list(range(200, 301)) + list(range(1300, 1310))
+    assert new_x == sorted(new_x) and len(set(new_x)) == len(new_x)
+
+    real, inside = sp.unshrink_coordinates([50, 100, 125, 175, 225, 287.5, 350, 450], smap)
+    assert list(real) == [50, 100, 200, 250, 300, 800, 1300, 1400]
+    assert list(inside) == [False, False, False, False, False, True, False, False]
+    assert sp.shrink_junctions([100, 100], [200, 1300], smap) == ([100, 100], [125, 350])
+
+    # Axis breaks over the plotted runs, labeled with real coordinates; breaks
+    # outside of the runs and of the introns are left out
+    tracks = [('a', sp.np.array([20.5]), sp.np.array([380.5]), sp.np.array([1.]))]
+    assert list(sp.extended_breaks(21, 380, 5)) == [0, 100, 200, 300, 400]
+    breaks, labels = sp.shrunk_axis_breaks(tracks, smap)
+    assert list(breaks) == [100, 200, 300] and list(labels) == [100, 275, 900]
+
+    transcripts = OrderedDict([('"t1"', (50, 1400, '"+"'))])
+    exons = {'"t1"': [(50, 100, '"+"'), (200, 300, '"+"'), (1300, 1400, '"+"')]}
+    annotation = sp.make_introns(transcripts, exons, smap)
+    assert annotation['transcripts']['"t1"'] == (50, 450, '"+"')
+    assert annotation['exons']['"t1"'] == [(50, 100, '"+"'), (125, 225, '"+"'), (350, 450, '"+"')]
+    assert annotation['introns']['"t1"'] == [(100, 125, '"+"'), (225, 350, '"+"')]
+    assert exons['"t1"'][1] == (200, 300, '"+"')